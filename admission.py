@@ -0,0 +1,230 @@
+"""
+Admission control shared by every worker on the host. Requests are sorted into route classes; when the
+requests in flight or the wait for a pooled database connection approach their limits, the classes are
+turned away with 503 from the lowest priority up, before the database is asked for more than it can serve.
+Each API key also has a token bucket, answered with 429 when it runs dry.
+
+The state lives in a memory-mapped file (under /dev/shm by default) that every worker maps. Each worker
+owns a slot it alone writes: its requests in flight and an average connection wait per class, summed or
+maxed over the live workers' slots when deciding. Token buckets are shared entries, updated under a byte
+range lock. The limits are soft: workers deciding at the same moment can each admit one request more.
+"""
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import random
+import struct
+import threading
+import time
+
+from metrics import pid_alive
+
+# Route classes, from the first to be shed to the last.
+CLASSES = ('media_upload', 'write', 'feed', 'auth')
+# A class is shed once the pressure, the load as a share of its limit, exceeds this.
+SHED_AT = {'media_upload': 0.7, 'write': 0.8, 'feed': 0.9, 'auth': 1.0}
+
+MAGIC = b'YADMIT01'
+# magic, slot count, bucket count
+HEADER = struct.Struct('8sqq')
+PID = struct.Struct('q')
+# requests in flight, average connection wait in seconds, monotonic time of the last wait
+CLASS_STATE = struct.Struct('qdd')
+# key hash, tokens, monotonic time of the last update
+BUCKET = struct.Struct('qdd')
+SLOT_SIZE = PID.size + CLASS_STATE.size * len(CLASSES)
+# Weight of each new connection wait in the average.
+WAIT_WEIGHT = 0.2
+
+class Rejected(Exception):
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.message = message
+
+def key_hash(api_key):
+    return int.from_bytes(hashlib.blake2b(api_key.encode(), digest_size=8).digest(), 'little', signed=True)
+
+class Ticket:
+    """
+    An admitted request, counted in flight until release() is called.
+    """
+    def __init__(self, admission, route_class):
+        self.admission = admission
+        self.route_class = route_class
+        self.released = False
+        # Set once release has been handed to the response, for streamed bodies that outlive the request.
+        self.deferred = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.admission._add_in_flight(self.route_class, -1)
+
+class Admission:
+    def __init__(self, path, max_in_flight=0, max_pool_wait=0, key_rate=0, key_burst=0, slots=256, buckets=4096, wait_half_life=1.0, retry_after=1):
+        """
+        max_pool_wait is in seconds and key_rate in requests per second; a limit of 0 is no limit.
+        Connection waits are forgotten with wait_half_life seconds of half-life once they stop.
+        """
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.key_rate = key_rate
+        self.key_burst = key_burst or max(key_rate, 1)
+        self.slots = slots
+        self.buckets = buckets
+        self.wait_half_life = wait_half_life
+        self.retry_after = retry_after
+        self.slots_offset = HEADER.size
+        self.buckets_offset = self.slots_offset + slots * SLOT_SIZE
+        size = self.buckets_offset + buckets * BUCKET.size
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER.size, 0)
+        try:
+            if os.fstat(self.fd).st_size != size or os.pread(self.fd, HEADER.size, 0) != HEADER.pack(MAGIC, slots, buckets):
+                os.ftruncate(self.fd, 0)
+                os.ftruncate(self.fd, size)
+                os.pwrite(self.fd, HEADER.pack(MAGIC, slots, buckets), 0)
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER.size, 0)
+        self.memory = mmap.mmap(self.fd, size)
+        self._forked()
+        os.register_at_fork(after_in_child=self._forked)
+
+    def _forked(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.slot = None
+
+    def _own_slot(self):
+        """
+        The offset of this process's slot, claimed on first use, or None when every slot is taken.
+        """
+        if self.pid == os.getpid():
+            return self.slot
+        with self.lock:
+            if self.pid == os.getpid():
+                return self.slot
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER.size, 0)
+            try:
+                self.slot = None
+                for index in range(self.slots):
+                    offset = self.slots_offset + index * SLOT_SIZE
+                    pid, = PID.unpack_from(self.memory, offset)
+                    if pid == 0 or not pid_alive(pid):
+                        self.memory[offset:offset + SLOT_SIZE] = bytes(SLOT_SIZE)
+                        PID.pack_into(self.memory, offset, os.getpid())
+                        self.slot = offset
+                        break
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER.size, 0)
+            self.pid = os.getpid()
+            return self.slot
+
+    def _class_offset(self, slot, route_class):
+        return slot + PID.size + CLASS_STATE.size * CLASSES.index(route_class)
+
+    def _add_in_flight(self, route_class, change):
+        slot = self._own_slot()
+        if slot is None:
+            return
+        offset = self._class_offset(slot, route_class)
+        with self.lock:
+            in_flight, wait, waited_at = CLASS_STATE.unpack_from(self.memory, offset)
+            CLASS_STATE.pack_into(self.memory, offset, max(in_flight + change, 0), wait, waited_at)
+
+    def _decayed(self, wait, waited_at, now):
+        return wait * 0.5 ** (max(now - waited_at, 0) / self.wait_half_life)
+
+    def record_wait(self, route_class, seconds):
+        """
+        Adds a connection checkout's wait to the class's average.
+        """
+        slot = self._own_slot()
+        if slot is None:
+            return
+        offset = self._class_offset(slot, route_class)
+        now = time.monotonic()
+        with self.lock:
+            in_flight, wait, waited_at = CLASS_STATE.unpack_from(self.memory, offset)
+            wait = self._decayed(wait, waited_at, now) * (1 - WAIT_WEIGHT) + seconds * WAIT_WEIGHT
+            CLASS_STATE.pack_into(self.memory, offset, in_flight, wait, now)
+
+    def load(self):
+        """
+        ({route class: requests in flight}, {route class: average connection wait}) over the live workers.
+        """
+        in_flight = dict.fromkeys(CLASSES, 0)
+        waits = dict.fromkeys(CLASSES, 0.0)
+        now = time.monotonic()
+        for index in range(self.slots):
+            offset = self.slots_offset + index * SLOT_SIZE
+            pid, = PID.unpack_from(self.memory, offset)
+            if pid == 0 or (pid != os.getpid() and not pid_alive(pid)):
+                continue
+            for route_class in CLASSES:
+                count, wait, waited_at = CLASS_STATE.unpack_from(self.memory, self._class_offset(offset, route_class))
+                in_flight[route_class] += count
+                waits[route_class] = max(waits[route_class], self._decayed(wait, waited_at, now))
+        return in_flight, waits
+
+    def pressure(self):
+        """
+        The load as a share of its limits, counting the request being admitted.
+        """
+        if not self.max_in_flight and not self.max_pool_wait:
+            return 0.0
+        in_flight, waits = self.load()
+        pressure = 0.0
+        if self.max_in_flight:
+            pressure = (sum(in_flight.values()) + 1) / self.max_in_flight
+        if self.max_pool_wait:
+            pressure = max(pressure, max(waits.values()) / self.max_pool_wait)
+        return pressure
+
+    def take_token(self, api_key):
+        """
+        Takes a token from the key's bucket, or returns the seconds until the next one.
+        Keys that hash to the same entry reset it for each other, which errs towards admitting.
+        """
+        key = key_hash(api_key)
+        offset = self.buckets_offset + (key % self.buckets) * BUCKET.size
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, BUCKET.size, offset)
+            try:
+                now = time.monotonic()
+                owner, tokens, updated_at = BUCKET.unpack_from(self.memory, offset)
+                if owner != key:
+                    tokens, updated_at = self.key_burst, now
+                tokens = min(self.key_burst, tokens + max(now - updated_at, 0) * self.key_rate)
+                wait = 0 if tokens >= 1 else (1 - tokens) / self.key_rate
+                BUCKET.pack_into(self.memory, offset, key, tokens - 1 if tokens >= 1 else tokens, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, BUCKET.size, offset)
+        return wait
+
+    def admit(self, route_class, api_key=None):
+        """
+        A Ticket for the request, or Rejected when its class is being shed or its key is out of tokens.
+        Retry-After is spread over a few seconds so that shed clients don't all come back at once.
+        """
+        if self.pressure() > SHED_AT[route_class]:
+            raise Rejected(503, self.retry_after + random.randint(0, self.retry_after), 'Server is overloaded, try again later')
+        if self.key_rate and api_key:
+            wait = self.take_token(api_key)
+            if wait:
+                raise Rejected(429, math.ceil(wait), 'Too many requests for this API key')
+        self._add_in_flight(route_class, 1)
+        return Ticket(self, route_class)
+
+    def in_flight(self):
+        """
+        This worker's requests in flight per class.
+        """
+        slot = self._own_slot()
+        if slot is None:
+            return dict.fromkeys(CLASSES, 0)
+        return {route_class: CLASS_STATE.unpack_from(self.memory, self._class_offset(slot, route_class))[0] for route_class in CLASSES}
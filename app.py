@@ -1,22 +1,176 @@
+from collections import Counter
 from functools import wraps
+import atexit
+import click
+import contextvars
+import hashlib
+import io
 from dotenv import load_dotenv
+import base64
+import binascii
+from datetime import datetime, timedelta
+import json
 import os
+import ssl
+import sys
+import threading
+import time
 
 import urllib
 
+from admission import Admission, Rejected
+from auth_cache import AuthCache, AuthenticatedUser, hash_api_key
+from bulk_import import FORMATS, ImportProgress, batches, input_format, read_rows
+from downvote_index import UserDownvoteIndex, contains
+from downvote_queue import DownvoteQueue
+from encoding import FastJSONProvider, compress_response
+from feed_cache import FeedCache
+from media_store import SIGNATURE_SIZE, MediaStoreMissing, blob_store_from_env, check_image, decode_media, digest_media, encode_media, image_type
+from metrics import BYTE_BUCKETS, COUNT_BUCKETS, ROW_BUCKETS, Metrics, RequestStats, counting_bytes
+from profanity import ProfanityFilterCache
+from query_profiler import RequestProfile, caller, explain, is_explainable, report
+from replicas import ReplicaSet, StickyWrites
+from schema_migrations import applied_versions, apply, has_tables, migration_files, record
+from search import PostSearchIndex
+from shared_memory import default_path
+from streaming import streamed_json_array
+
 load_dotenv()
 
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, ForeignKey, Text, cast, desc, func, literal_column
-from sqlalchemy.orm import relationship, declarative_base, scoped_session, sessionmaker
+from sqlalchemy import Column, Index, event, Integer, String, Boolean, DateTime, ForeignKey, Text, bindparam, delete, desc, exists, false, func, insert, or_, select, text, tuple_, union_all, update
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.orm import Session, relationship, declarative_base, scoped_session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
 from sqlalchemy import create_engine
 
-sql = create_engine(f"mysql+pymysql://{os.environ.get('DB_UN')}:{os.environ.get('DB_PW')}@{os.environ.get('DB_SERVER')}/{os.environ.get('DB_NAME')}", connect_args={'ssl': {'ca': 'DigiCertGlobalRootCA.crt.pem'}})
+def env_flag(name, default=False):
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+APP_ROOT = os.path.dirname(os.path.abspath(__file__))
+
+def database_url(server=None):
+    if os.environ.get('DB_URL') and server is None:
+        return os.environ['DB_URL']
+    return f"mysql+pymysql://{os.environ.get('DB_UN')}:{os.environ.get('DB_PW')}@{server or os.environ.get('DB_SERVER')}/{os.environ.get('DB_NAME')}"
+
+METRICS_ENABLED = env_flag('METRICS_ENABLED', True)
+ADMISSION_ENABLED = env_flag('ADMISSION_ENABLED')
+
+class MeteredPool:
+    """
+    Records how long each checkout waited for a connection, in the metrics and for admission control.
+    """
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - started
+            if METRICS_ENABLED:
+                metrics.observe('db_pool_checkout_wait_seconds', waited)
+            if ADMISSION_ENABLED:
+                record_pool_wait(waited)
+
+class MeteredQueuePool(MeteredPool, QueuePool):
+    pass
+
+class MeteredAsyncQueuePool(MeteredPool, AsyncAdaptedQueuePool):
+    pass
+
+def build_engine(url=None, asynchronous=False):
+    """
+    Builds the process-wide engine, or with asynchronous an AsyncEngine for asgi.py. The pool is configured
+    from the environment: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING and DB_ECHO.
+    """
+    url = url or database_url()
+    options = {'echo': env_flag('DB_ECHO')}
+    if url.startswith('mysql'):
+        ca = 'DigiCertGlobalRootCA.crt.pem'
+        options.update(
+            # aiomysql takes an SSLContext where PyMySQL takes its options.
+            connect_args={'ssl': ssl.create_default_context(cafile=ca) if asynchronous else {'ca': ca}},
+            pool_size=env_int('DB_POOL_SIZE', 5),
+            max_overflow=env_int('DB_MAX_OVERFLOW', 10),
+            pool_timeout=env_int('DB_POOL_TIMEOUT', 30),
+            # Azure MySQL drops idle connections; recycle them before the server does.
+            pool_recycle=env_int('DB_POOL_RECYCLE', 1800),
+            pool_pre_ping=env_flag('DB_POOL_PRE_PING', True)
+        )
+        if METRICS_ENABLED or ADMISSION_ENABLED:
+            options['poolclass'] = MeteredAsyncQueuePool if asynchronous else MeteredQueuePool
+    if asynchronous:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        return create_async_engine(url, **options)
+    return create_engine(url, **options)
 
-sessionFactory = scoped_session(sessionmaker(bind=sql))
+sql = build_engine()
 
-from flask import Flask, redirect, request
+class RoutingSession(Session):
+    """
+    Sends a session's statements to the replica engine stored in its info by reads_from_replica, if any,
+    and to the primary otherwise.
+    """
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        replica = self.info.get('replica')
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+# Sessions are scoped to the thread, or to the request's task when asgi.py serves it from an event loop.
+session_scope = contextvars.ContextVar('session_scope', default=None)
+
+def current_session_scope():
+    scope = session_scope.get()
+    return threading.get_ident() if scope is None else scope
+
+sessionFactory = scoped_session(sessionmaker(bind=sql, class_=RoutingSession), scopefunc=current_session_scope)
+
+# Set by asgi.py while it serves a request from the event loop, to a function running a blocking call in a thread.
+blocking_runner = contextvars.ContextVar('blocking_runner', default=None)
+
+def off_loop(function, *args):
+    """
+    Calls function(*args), in a thread when the request is served from asgi.py's event loop, so that file
+    I/O and compression don't hold up the other requests on the loop.
+    """
+    run = blocking_runner.get()
+    return function(*args) if run is None else run(function, *args)
+
+_engine_lock = threading.Lock()
+
+from flask import Flask, g, has_app_context, make_response, redirect, request, send_file, url_for
+from flask.cli import AppGroup
 app:Flask = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24)
+# JSON_BACKEND is orjson or json, the default being orjson when it is installed. JSON_DATETIME_FORMAT=iso
+# writes ISO 8601 instead of the HTTP dates Flask has always sent, which clients may parse.
+JSON_BACKEND = os.environ.get('JSON_BACKEND') or None
+JSON_DATETIME_FORMAT = os.environ.get('JSON_DATETIME_FORMAT', 'http')
+
+def request_stats():
+    return g.get('request_stats') if has_app_context() else None
+
+class MeteredJSONProvider(FastJSONProvider):
+    def _encode(self, obj):
+        started = time.perf_counter()
+        try:
+            return super()._encode(obj)
+        finally:
+            stats = request_stats()
+            if stats is not None:
+                stats.serialization += time.perf_counter() - started
+
+# Installed once, before the row shapes below are registered with it.
+app.json = (MeteredJSONProvider if METRICS_ENABLED else FastJSONProvider)(app, backend=JSON_BACKEND, date_format=JSON_DATETIME_FORMAT)
 
 from flasgger import Swagger
 app.config['SWAGGER'] = {
@@ -26,7 +180,45 @@ app.config['SWAGGER'] = {
     "basePath": "/api",
     "auth_config": {}
 }
-swagger = Swagger(app, template={
+OPENAPI_SPEC_FILE = os.environ.get('OPENAPI_SPEC_FILE') or os.path.join(APP_ROOT, 'openapi.json')
+
+def source_digest():
+    with open(__file__, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+class PrebuiltSpecSwagger(Swagger):
+    """
+    Serves the OpenAPI spec from OPENAPI_SPEC_FILE, so workers don't each parse the YAML docstrings of every
+    route. The file is written by `flask build-openapi-spec` at build time, or else by the first worker asked
+    for the spec, and is ignored once app.py changes.
+    """
+    def get_apispecs(self, endpoint='apispec_1'):
+        if self.app.debug or endpoint in self.apispecs:
+            return super().get_apispecs(endpoint)
+        digest = source_digest()
+        try:
+            with open(OPENAPI_SPEC_FILE) as file:
+                prebuilt = json.load(file)
+        except (OSError, ValueError):
+            prebuilt = {}
+        spec = prebuilt.get('specs', {}).get(endpoint) if prebuilt.get('source') == digest else None
+        if spec is None:
+            spec = super().get_apispecs(endpoint)
+            try:
+                write_openapi_spec({endpoint: spec}, digest)
+            except OSError:
+                # A read-only deployment; this worker keeps the spec in memory.
+                pass
+        self.apispecs[endpoint] = spec
+        return spec
+
+def write_openapi_spec(specs, digest):
+    temporary = f'{OPENAPI_SPEC_FILE}.{os.getpid()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump({'source': digest, 'specs': specs}, file)
+    os.replace(temporary, OPENAPI_SPEC_FILE)
+
+swagger = PrebuiltSpecSwagger(app, template={
   "info": {
     "title": "The Y App API Docs",
     "description": "The Y App API Docs. Please note that this is a work in progress and is subject to change. Please contact for more information.",
@@ -50,10 +242,18 @@ Base = declarative_base()
 class Media(Base):
     __tablename__ = 'media'
     id = Column(Integer, primary_key=True)
+    # Null when the bytes live in the blob store under sha256.
     base64 = Column(Text)
+    sha256 = Column(String(64))
+    mime_type = Column(String(128))
+    size = Column(Integer)
     author_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'))
     created_at = Column(DateTime, default=func.now())
 
+    __table_args__ = (
+        Index('ix_media_sha256', 'sha256', unique=True),
+    )
+
 class User(Base):
     __tablename__ = 'users'
     id = Column(Integer, primary_key=True)
@@ -67,6 +267,12 @@ class User(Base):
     email = Column(String(128), unique=True)
     password = Column(String(128))
     api_key = Column(String(256))
+    # SHA-256 of api_key, kept in sync by hash_user_api_key; requests are authenticated against it.
+    api_key_digest = Column(String(64), index=True)
+
+    __table_args__ = (
+        Index('ix_users_names_fulltext', 'username', 'first_name', 'last_name', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
 
 class Post(Base):
     __tablename__ = 'posts'
@@ -76,42 +282,625 @@ class Post(Base):
     Media_id = Column(Integer, ForeignKey('media.id'), default=None, nullable=True)
     created_at = Column(DateTime, default=func.now())
     updated_at = Column(DateTime, default=func.now(), onupdate=func.now())
+    # Denormalized from the downvotes table by apply_downvotes; rebuilt by `flask reconcile-downvotes`.
+    downvote_count = Column(Integer, default=0, server_default='0', nullable=False)
+    penalized_created_at = Column(DateTime, default=func.now())
 
     author = relationship('User', backref='posts')
 
+    __table_args__ = (
+        Index('ix_posts_penalized_created_at', 'penalized_created_at', 'id'),
+        Index('ix_posts_content_fulltext', 'content', mysql_prefix='FULLTEXT').ddl_if(dialect='mysql'),
+    )
+
 class Downvote(Base):
     __tablename__ = 'downvotes'
     post_id = Column(Integer, ForeignKey('posts.id', ondelete='CASCADE'), primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id', ondelete='CASCADE'), primary_key=True)
     created_at = Column(DateTime, default=func.now())
 
+    __table_args__ = (
+        # The primary key leads with post_id; per-user lookups need their own index.
+        Index('ix_downvotes_user_id_post_id', 'user_id', 'post_id'),
+    )
+
 class Bad_Words(Base):
     __tablename__ = 'bad_words'
     id = Column(Integer, primary_key=True)
     word = Column(String(128))
 
-# Base.metadata.create_all(sql)
+@event.listens_for(User.api_key, 'set')
+def hash_user_api_key(user, api_key, old_api_key, initiator):
+    user.api_key_digest = hash_api_key(api_key) if api_key else None
+
+# The schema is created and migrated by `flask db upgrade`.
 
 def gen_api_key():
     return os.urandom(128).hex()
 
-def recreates_engine():
+# Invalidations reach every worker on the host through AUTH_CACHE_SHM_PATH.
+auth_cache = AuthCache(
+    os.environ.get('AUTH_CACHE_SHM_PATH') or default_path('y-auth-cache'),
+    ttl=env_int('AUTH_CACHE_TTL', 30),
+    max_size=env_int('AUTH_CACHE_SIZE', 10000)
+)
+
+def authenticate(session, username, api_key):
+    """
+    Returns the AuthenticatedUser for the username and API key, or None.
+    Served from the auth cache when possible; misses are an indexed lookup on the key digest.
+    """
+    if not isinstance(api_key, str) or not api_key:
+        return None
+    digest = hash_api_key(api_key)
+    user = auth_cache.get(digest)
+    if user is not None:
+        return user if user.username == username else None
+    generation = auth_cache.generation(username)
+    row = session.execute(
+        select(User.id, User.username, User.profanity_filter)
+            .where(User.username == username).where(User.api_key_digest == digest)
+    ).first()
+    if row is None:
+        return None
+    user = AuthenticatedUser(*row)
+    auth_cache.put(digest, user, generation)
+    return user
+
+def find_user(session, username, api_key):
+    """
+    Loads the user row for the username and API key, bypassing the auth cache, for handlers that modify the user.
+    """
+    if not isinstance(api_key, str) or not api_key:
+        return None
+    return session.query(User).filter(User.username == username).filter(User.api_key_digest == hash_api_key(api_key)).first()
+
+blob_store = blob_store_from_env()
+
+MEDIA_MAX_AGE = 365 * 24 * 60 * 60
+
+def stored_blobs():
+    """
+    The blob store, for media whose bytes were moved there. Without MEDIA_STORE_PATH they can't be read,
+    which MediaStoreMissing reports as a 503 rather than failing on None.
+    """
+    if blob_store is None:
+        raise MediaStoreMissing('Media was moved to the blob store, but MEDIA_STORE_PATH is not set')
+    return blob_store
+
+@app.errorhandler(MediaStoreMissing)
+def media_store_missing(error):
+    app.logger.error('%s', error)
+    return {'message': 'Media store is not configured'}, 503
+
+def read_media_blobs(media):
+    store = stored_blobs()
+    return {item.id: encode_media(item.mime_type, store.get(item.sha256)) for item in media}
+
+def load_media_base64(session, media_ids):
+    """
+    Returns {media_id: base64 string} for the media, in one query, reading stored blobs from the blob store.
+    """
+    if not media_ids:
+        return {}
+    media = session.execute(select(Media.id, Media.base64, Media.sha256, Media.mime_type).where(Media.id.in_(media_ids))).all()
+    stored = [item for item in media if item.base64 is None]
+    blobs = off_loop(read_media_blobs, stored) if stored else {}
+    return {item.id: item.base64 if item.base64 is not None else blobs[item.id] for item in media}
+
+def attach_media(session, rows, fields):
+    """
+    Fills each (id field, media field) pair of the rows with the media's base64 string, or with its
+    /api/media URL when the client asked for media=url.
+    """
+    inline = request.args.get('media') != 'url'
+    media = load_media_base64(session, {row[id_field] for row in rows for id_field, _ in fields if row[id_field] is not None}) if inline else {}
+    for row in rows:
+        for id_field, field in fields:
+            media_id = row[id_field]
+            if media_id is None:
+                row[field] = None
+            else:
+                row[field] = media.get(media_id) if inline else url_for('get_media', media_id=media_id)
+    return rows
+
+DOWNVOTE_BATCH_MAX = env_int('DOWNVOTE_BATCH_MAX', 500)
+USER_BATCH_MAX = 100
+app.json.register_rows(['id', 'first_name', 'last_name', 'username', 'profile_picture_id', 'profile_picture'])
+
+def payload_etag(payload):
+    """
+    ETag of a response payload before its media is attached. The media ids and the media mode are part
+    of it, and media never changes, so clients can be answered with 304 without loading any media.
+    """
+    source = json.dumps([request.args.get('media'), payload], default=str, sort_keys=True)
+    return hashlib.sha256(source.encode()).hexdigest()
+
+def not_modified(etag, last_modified=None, headers=None):
+    response = app.response_class(status=304, headers=headers)
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
+
+def penalize(created_at, downvote_count):
+    """
+    Every downvote pushes a post one day further back in the feed.
+    """
+    return created_at - timedelta(days=downvote_count)
+
+def write_downvote_counts(session, counts):
+    """
+    Stores {post_id: (created_at, downvote_count)} without touching the posts' updated_at.
+    """
+    if not counts:
+        return
+    session.execute(
+        update(Post.__table__)
+            .where(Post.__table__.c.id == bindparam('post_id'))
+            .values(
+                downvote_count=bindparam('count'),
+                penalized_created_at=bindparam('penalized_created_at'),
+                updated_at=Post.__table__.c.updated_at
+            ),
+        [{'post_id': post_id, 'count': count, 'penalized_created_at': penalize(created_at, count)} for post_id, (created_at, count) in counts.items()]
+    )
+    if feed_cache is not None:
+        after_commit(session, lambda: [
+            feed_cache.downvotes_changed(post_id, penalize(created_at, count), count) for post_id, (created_at, count) in counts.items()
+        ])
+
+def apply_downvotes(session, intents):
+    """
+    Applies {(post_id, user_id): whether the post should be downvoted} in the caller's transaction.
+    The posts are locked in id order, missing downvotes are inserted and unwanted ones deleted in bulk,
+    and each post's count is adjusted once. Returns the created and deleted keys and the ids of missing posts.
+    """
+    if not intents:
+        return [], [], []
+    posts = {post.id: post for post in session.execute(
+        select(Post.id, Post.created_at, Post.downvote_count)
+            .where(Post.id.in_({post_id for post_id, _ in intents})).order_by(Post.id).with_for_update()
+    )}
+    # Matched as (post_id, user_id) pairs: separate IN lists would probe every post for every user of a bulk import.
+    keys = [key for key in intents if key[0] in posts]
+    existing = set(session.execute(
+        select(Downvote.post_id, Downvote.user_id).where(tuple_(Downvote.post_id, Downvote.user_id).in_(keys))
+    ).tuples()) if keys else set()
+    created = [key for key, downvoted in intents.items() if downvoted and key[0] in posts and key not in existing]
+    deleted = [key for key, downvoted in intents.items() if not downvoted and key in existing]
+    missing = sorted({post_id for post_id, _ in intents if post_id not in posts})
+    if created:
+        session.execute(insert(Downvote), [{'post_id': post_id, 'user_id': user_id} for post_id, user_id in created])
+    for user_id in {user_id for _, user_id in deleted}:
+        session.execute(
+            delete(Downvote).where(Downvote.user_id == user_id)
+                .where(Downvote.post_id.in_([post_id for post_id, deleter in deleted if deleter == user_id]))
+                .execution_options(synchronize_session=False)
+        )
+    deltas = Counter(post_id for post_id, _ in created)
+    deltas.subtract(post_id for post_id, _ in deleted)
+    write_downvote_counts(session, {
+        post_id: (posts[post_id].created_at, max(posts[post_id].downvote_count + delta, 0))
+        for post_id, delta in deltas.items() if delta
+    })
+    if downvote_index is not None and (created or deleted):
+        after_commit(session, lambda: downvote_index.changed({user_id for _, user_id in created + deleted}))
+    return created, deleted, missing
+
+downvote_index = UserDownvoteIndex(
+    os.environ.get('DOWNVOTE_INDEX_SHM_PATH') or default_path('y-downvote-index'),
+    max_users=env_int('DOWNVOTE_INDEX_SIZE', 0),
+    ttl=env_int('DOWNVOTE_INDEX_TTL', 10)
+) if env_int('DOWNVOTE_INDEX_SIZE', 0) > 0 else None
+
+def viewer_downvotes(session, user_id):
+    """
+    The post ids the user downvoted, ascending, from the per-user index; None when the index is disabled.
+    """
+    if downvote_index is None:
+        return None
+    return downvote_index.get(user_id, lambda user_id: session.scalars(
+        select(Downvote.post_id).where(Downvote.user_id == user_id).order_by(Downvote.post_id)
+    ))
+
+def downvoted_by(user_id):
+    return exists().where(Downvote.post_id == Post.id).where(Downvote.user_id == user_id)
+
+def flush_downvotes(intents):
+    session = sessionFactory()
+    try:
+        apply_downvotes(session, intents)
+        session.commit()
+    finally:
+        sessionFactory.remove()
+
+downvote_queue = None
+if env_flag('DOWNVOTE_WRITE_BEHIND'):
+    downvote_queue = DownvoteQueue(
+        flush_downvotes,
+        max_batch=env_int('DOWNVOTE_FLUSH_SIZE', 500),
+        interval=env_int('DOWNVOTE_FLUSH_INTERVAL_MS', 500) / 1000
+    )
+    atexit.register(downvote_queue.stop)
+
+def overlay_queued_downvotes(user_id, rows):
+    """
+    Shows the viewer's queued downvote changes in feed rows, so they read their own writes before the flush.
+    """
+    intents = downvote_queue.intents_for(user_id) if downvote_queue is not None else {}
+    for row in rows:
+        downvoted = intents.get(row['post_id'])
+        if downvoted is not None and downvoted != row['is_downvoted']:
+            row['downvotes'] = max(row['downvotes'] + (1 if downvoted else -1), 0)
+            row['is_downvoted'] = downvoted
+    return rows
+
+def ping_engine(engine):
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        return True
+    except DBAPIError:
+        return False
+
+def reconnect_engine(stale):
+    """
+    Replaces the engine, but only if it is still the one that lost connectivity.
+    Concurrent requests that hit the same outage rebuild it once between them.
+    """
+    global sql
+    with _engine_lock:
+        if sql is not stale:
+            return
+        sessionFactory.remove()
+        sql = build_engine()
+        sessionFactory.configure(bind=sql)
+    stale.dispose()
+
+def reconnects_engine():
+    """
+    Runs the route on the shared engine. When the database connection is lost mid-request,
+    the engine is rebuilt if the database no longer answers on the existing pool; read-only
+    requests are then retried once, writes are answered with 503 so the client can retry.
+    """
     def decorator(func):
         @wraps(func)
         def wrapper(*args, **kwargs):
-            global sql, sessionFactory
+            engine = sql
+            try:
+                return func(*args, **kwargs)
+            except DBAPIError as error:
+                if not error.connection_invalidated:
+                    raise
+                sessionFactory.remove()
+                if not off_loop(ping_engine, engine):
+                    reconnect_engine(engine)
+                if request.method in ('GET', 'HEAD', 'TRACE'):
+                    return func(*args, **kwargs)
+                return {'message': 'Database connection lost'}, 503
+
+        return wrapper
+    return decorator
+
+DB_REPLICAS = [server.strip() for server in os.environ.get('DB_REPLICAS', '').split(',') if server.strip()]
+# Replicas are server names sharing the primary's credentials, or full database URLs.
+replicas = ReplicaSet(
+    [build_engine(server if '://' in server else database_url(server)) for server in DB_REPLICAS],
+    ping_engine,
+    strategy=os.environ.get('DB_REPLICA_STRATEGY', 'round_robin'),
+    retry_interval=env_int('DB_REPLICA_RETRY_INTERVAL', 5)
+) if DB_REPLICAS else None
+# Shared by the workers on the host through DB_STICKY_SHM_PATH.
+sticky_writes = StickyWrites(
+    os.environ.get('DB_STICKY_SHM_PATH') or default_path('y-sticky-writes'),
+    window=env_int('DB_STICKY_WINDOW', 5)
+) if DB_REPLICAS else None
 
-            if sql:
-                sql.dispose()
+def dispose_inherited_connections():
+    """
+    Drops the pooled connections a forked process inherited, without closing them: they are its parent's
+    sockets. Importing the app opens none, but this keeps gunicorn's preload_app safe if that changes.
+    """
+    sql.dispose(close=False)
+    if replicas is not None:
+        replicas.dispose(close=False)
 
-            sql = create_engine(f"mysql+pymysql://{os.environ.get('DB_UN')}:{os.environ.get('DB_PW')}@{os.environ.get('DB_SERVER')}/{os.environ.get('DB_NAME')}", connect_args={'ssl': {'ca': 'DigiCertGlobalRootCA.crt.pem'}}, echo=True)
-            sessionFactory = scoped_session(sessionmaker(bind=sql))
+os.register_at_fork(after_in_child=dispose_inherited_connections)
 
-            return func(*args, **kwargs)
+def reads_from_replica():
+    """
+    Runs a read-only route on a replica, unless the requesting user wrote within the stickiness window.
+    When the replica fails, the request is retried on the primary and the replica is avoided until it answers again.
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if replicas is None or request.method not in ('GET', 'HEAD') or sticky_writes.active(request.args.get('username')):
+                return func(*args, **kwargs)
+            if 'run_concurrently' in sessionFactory().info:
+                # Served by asgi.py, whose session runs on the async primary engine.
+                return func(*args, **kwargs)
+            replica = replicas.choose()
+            if replica is None:
+                return func(*args, **kwargs)
+            sessionFactory().info['replica'] = replica
+            try:
+                return func(*args, **kwargs)
+            except DBAPIError:
+                sessionFactory.remove()
+                if ping_engine(replica):
+                    raise
+                replicas.mark_down(replica)
+                return func(*args, **kwargs)
 
         return wrapper
     return decorator
 
+@app.after_request
+def stick_writer_to_primary(response):
+    """
+    Keeps a user's reads on the primary for DB_STICKY_WINDOW seconds after a successful write, so they see it.
+    """
+    if replicas is not None and request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE') and response.status_code < 400:
+        data = request.get_json(silent=True)
+        if isinstance(data, dict) and isinstance(data.get('username'), str):
+            sticky_writes.mark(data['username'])
+    return response
+
+@app.teardown_appcontext
+def remove_session(exception=None):
+    sessionFactory.remove()
+
+def concurrently(session, *loads):
+    """
+    Runs independent read-only loads, each called with a session, and returns their results in order.
+    Under asgi.py each load gets its own connection and they wait on the database together;
+    otherwise they run one after the other on session.
+    Under asgi.py, session's connection is released first, so a request never holds one connection while waiting
+    for more and a busy pool can't deadlock on itself. Its transaction ends: call this before writing anything.
+    """
+    run_concurrently = session.info.get('run_concurrently')
+    if run_concurrently is None:
+        return [load(session) for load in loads]
+    session.close()
+    return run_concurrently(loads)
+
+def after_commit(session, callback):
+    """
+    Runs callback once the session's current transaction commits; it is dropped on rollback.
+    Used to keep in-process caches in step with the database.
+    """
+    session.info.setdefault('after_commit', []).append(callback)
+
+@event.listens_for(Session, 'after_commit')
+def run_after_commit(session):
+    for callback in session.info.pop('after_commit', []):
+        callback()
+
+@event.listens_for(Session, 'after_rollback')
+def drop_after_commit(session):
+    session.info.pop('after_commit', None)
+
+metrics = Metrics(
+    directory=os.environ.get('METRICS_DIR') or None,
+    flush_interval=env_int('METRICS_FLUSH_INTERVAL_MS', 1000) / 1000
+)
+metrics.histogram('http_request_duration_seconds', 'Request wall time, including streaming the response body')
+metrics.histogram('http_request_db_seconds', 'Time spent executing SQL statements per request')
+metrics.histogram('http_request_statements', 'SQL statements executed per request', COUNT_BUCKETS)
+metrics.histogram('http_request_rows', 'Rows fetched or affected per request, as reported by the database driver', ROW_BUCKETS)
+metrics.histogram('http_response_bytes', 'Response body size', BYTE_BUCKETS)
+metrics.histogram('http_response_serialization_seconds', 'Time spent encoding JSON per request')
+metrics.histogram('db_pool_checkout_wait_seconds', 'Time spent waiting for a pooled database connection')
+metrics.histogram('worker_startup_seconds', 'Time from a gunicorn worker being forked to it being ready to serve')
+metrics.gauge('db_pool_size', 'Connections kept open by the pools')
+metrics.gauge('db_pool_checked_out', 'Pooled connections in use')
+metrics.gauge('db_pool_overflow', 'Connections opened beyond the pool size')
+
+@metrics.collector
+def sample_pool():
+    pool = sql.pool
+    if isinstance(pool, QueuePool):
+        metrics.set('db_pool_size', pool.size())
+        metrics.set('db_pool_checked_out', pool.checkedout())
+        metrics.set('db_pool_overflow', max(pool.overflow(), 0))
+
+def record_request(stats, endpoint, method, status, size):
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - stats.started, endpoint=endpoint, method=method, status=status)
+    metrics.observe('http_request_db_seconds', stats.db_time, endpoint=endpoint)
+    metrics.observe('http_request_statements', stats.statements, endpoint=endpoint)
+    metrics.observe('http_request_rows', stats.rows, endpoint=endpoint)
+    metrics.observe('http_response_bytes', size, endpoint=endpoint)
+    metrics.observe('http_response_serialization_seconds', stats.serialization, endpoint=endpoint)
+    off_loop(metrics.flush)
+
+if METRICS_ENABLED:
+    atexit.register(metrics.flush, True)
+
+    @app.before_request
+    def start_request_stats():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request_stats(response):
+        stats = request_stats()
+        if stats is None:
+            return response
+        stats.responded = True
+        endpoint, method, status = request.endpoint or 'unmatched', request.method, str(response.status_code)
+        if response.content_length is not None or not response.is_streamed:
+            record_request(stats, endpoint, method, status, response.content_length or len(response.get_data()))
+            return response
+        # Streamed bodies are produced after this hook; they are measured once the server closes them.
+        sent = [0]
+        def on_chunk(size):
+            sent[0] += size
+        response.response = counting_bytes(response.response, on_chunk)
+        response.call_on_close(lambda: record_request(stats, endpoint, method, status, sent[0]))
+        return response
+
+    @app.teardown_request
+    def record_failed_request(exception=None):
+        stats = request_stats()
+        if stats is not None and not stats.responded:
+            record_request(stats, request.endpoint or 'unmatched', request.method, '500', 0)
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info['statement_started'] = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        stats = request_stats()
+        if stats is None:
+            return
+        stats.db_time += time.perf_counter() - conn.info.pop('statement_started', time.perf_counter())
+        stats.statements += 1
+        # A streamed result's rows haven't been read yet: PyMySQL's unbuffered cursors report rowcount as
+        # 2**64 - 1 (-1 as an unsigned long long), so only a buffered cursor's count is trusted.
+        if context is not None and context.execution_options.get('stream_results'):
+            return
+        if 0 <= cursor.rowcount < 2 ** 63:
+            stats.rows += cursor.rowcount
+
+COMPRESS_ENABLED = env_flag('COMPRESS_ENABLED', True)
+COMPRESS_MIN_SIZE = env_int('COMPRESS_MIN_SIZE', 1024)
+COMPRESS_LEVEL = env_int('COMPRESS_LEVEL', 6)
+COMPRESS_BROTLI_QUALITY = env_int('COMPRESS_BROTLI_QUALITY', 4)
+
+if COMPRESS_ENABLED:
+    # Registered after the metrics hooks so it runs before them, and they count the bytes actually sent.
+    @app.after_request
+    def compress(response):
+        """
+        Compresses JSON and text responses with gzip, or br when the brotli package is installed, as the client accepts.
+        """
+        return compress_response(response, request.accept_encodings, COMPRESS_MIN_SIZE, COMPRESS_LEVEL, COMPRESS_BROTLI_QUALITY, off_loop)
+
+QUERY_PROFILER = env_flag('QUERY_PROFILER')
+QUERY_PROFILER_REPEATS = env_int('QUERY_PROFILER_REPEATS', 5)
+QUERY_PROFILER_SLOW_MS = env_int('QUERY_PROFILER_SLOW_MS', 100)
+QUERY_PROFILER_MAX_STATEMENTS = env_int('QUERY_PROFILER_MAX_STATEMENTS', 0)
+# Raises QueryLimitExceeded at the end of requests over the limits above, so tests fail on them.
+QUERY_PROFILER_STRICT = env_flag('QUERY_PROFILER_STRICT')
+
+def query_profile():
+    return g.get('query_profile') if has_app_context() else None
+
+if QUERY_PROFILER:
+    @app.before_request
+    def start_query_profile():
+        g.query_profile = RequestProfile()
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def start_profiled_statement(conn, cursor, statement, parameters, context, executemany):
+        conn.info['profiled_started'] = time.perf_counter()
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def profile_statement(conn, cursor, statement, parameters, context, executemany):
+        profile = query_profile()
+        if profile is None:
+            return
+        elapsed = time.perf_counter() - conn.info.pop('profiled_started', time.perf_counter())
+        # Start above this hook, which is in app.py too.
+        source = caller(APP_ROOT, sys._getframe().f_back)
+        profile.record(statement, elapsed, source)
+        if elapsed * 1000 < QUERY_PROFILER_SLOW_MS:
+            return
+        lines = [f'Slow statement in {request.endpoint} ({elapsed * 1000:.1f} ms) from {source}:', statement]
+        # A streamed result still holds the connection, so it can't be explained until it has been read.
+        if not executemany and is_explainable(statement) and not (context is not None and context.execution_options.get('stream_results')):
+            try:
+                lines += explain(conn.connection.dbapi_connection, conn.dialect.name, statement, parameters)
+            except Exception as error:
+                lines.append(f'EXPLAIN failed: {error}')
+        app.logger.warning('\n  '.join(lines))
+
+    @app.teardown_request
+    def report_query_profile(exception=None):
+        profile = g.pop('query_profile', None)
+        if profile is not None:
+            problems = profile.problems(QUERY_PROFILER_REPEATS, QUERY_PROFILER_MAX_STATEMENTS)
+            report(app.logger.warning, request.endpoint or 'unmatched', problems, strict=QUERY_PROFILER_STRICT and exception is None)
+
+# Route classes for admission control, by endpoint; routes left out, like the status routes, are always admitted.
+ADMISSION_CLASSES = {
+    'api_login': 'auth',
+    'api_change_password': 'auth',
+    'api_logout': 'auth',
+    'get_user': 'feed',
+    'get_user_by_id': 'feed',
+    'get_users_by_ids': 'feed',
+    'get_posts': 'feed',
+    'get_media': 'feed',
+    'create_user': 'write',
+    'update_user': 'write',
+    'create_post': 'write',
+    'create_downvote': 'write',
+    'apply_downvote_batch': 'write',
+    'delete_post': 'write',
+    'create_media': 'media_upload'
+}
+
+admission = Admission(
+    os.environ.get('ADMISSION_SHM_PATH') or default_path('y-admission'),
+    max_in_flight=env_int('ADMISSION_MAX_IN_FLIGHT', 0),
+    max_pool_wait=env_int('ADMISSION_MAX_POOL_WAIT_MS', 0) / 1000,
+    key_rate=env_int('ADMISSION_KEY_RATE', 0),
+    key_burst=env_int('ADMISSION_KEY_BURST', 0),
+    retry_after=env_int('ADMISSION_RETRY_AFTER', 1)
+) if ADMISSION_ENABLED else None
+
+def record_pool_wait(waited):
+    ticket = g.get('admission_ticket') if has_app_context() else None
+    if ticket is not None:
+        admission.record_wait(ticket.route_class, waited)
+
+def request_api_key():
+    api_key = request.args.get('api_key')
+    if api_key is None:
+        data = request.get_json(silent=True)
+        api_key = data.get('api_key') if isinstance(data, dict) else None
+    return api_key if isinstance(api_key, str) else None
+
+if ADMISSION_ENABLED:
+    metrics.gauge('admission_in_flight', 'Requests admitted and not yet answered, by route class')
+
+    @metrics.collector
+    def sample_admission():
+        for route_class, count in admission.in_flight().items():
+            metrics.set('admission_in_flight', count, route_class=route_class)
+
+    @app.before_request
+    def admit_request():
+        """
+        Sheds the request with 503 while the host is overloaded and its route class is among the first to
+        go, and answers 429 when its API key has used up its rate (ADMISSION_KEY_RATE per second).
+        """
+        route_class = ADMISSION_CLASSES.get(request.endpoint)
+        if route_class is None:
+            return None
+        try:
+            g.admission_ticket = admission.admit(route_class, request_api_key())
+        except Rejected as rejected:
+            return {'message': rejected.message}, rejected.status, {'Retry-After': str(rejected.retry_after)}
+        return None
+
+    @app.after_request
+    def release_admission_after_body(response):
+        ticket = g.get('admission_ticket')
+        if ticket is not None and response.is_streamed:
+            # The body is still to be produced; the request counts as in flight until it has been sent.
+            ticket.deferred = True
+            response.call_on_close(ticket.release)
+        return response
+
+    @app.teardown_request
+    def release_admission(exception=None):
+        ticket = g.get('admission_ticket')
+        if ticket is not None and not ticket.deferred:
+            ticket.release()
+
 @app.route('/', methods=['GET'])
 def index():
     return redirect('/apidocs/')
@@ -130,7 +919,7 @@ def api_status():
     return {'message': 'API is online'}
 
 @app.route('/api/status/db', methods=['TRACE'])
-@recreates_engine()
+@reconnects_engine()
 def api_status_db():
     """
     Endpoint to check the DB status.
@@ -142,12 +931,27 @@ def api_status_db():
             description: DB is online
     """
     session = scoped_session(sessionFactory)
-    session.execute('SELECT 1')
+    session.execute(text('SELECT 1'))
     session.close()
     return {'message': 'DB is online'}
 
+@app.route('/api/status/metrics', methods=['GET'])
+def api_status_metrics():
+    """
+    Endpoint to get the API's performance metrics, merged across workers, in the Prometheus text format.
+    ---
+    tags:
+      - Status
+    produces:
+        - text/plain
+    responses:
+        200:
+            description: Request timings, SQL statements, rows, response sizes and connection pool usage per endpoint
+    """
+    return app.response_class(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/api/login', methods=['POST'])
-@recreates_engine()
+@reconnects_engine()
 def api_login():
     """
     Endpoint to login.
@@ -168,6 +972,12 @@ def api_login():
                         password: 
                             type: string
                             description: The user's password
+    parameters:
+        - in: query
+          name: media
+          type: string
+          required: false
+          description: When set to url, media fields hold /api/media URLs instead of inline base64 strings
     responses:
         200:
             description: User logged in
@@ -185,7 +995,10 @@ def api_login():
                         description: The user's email
                     profile_picture:
                         type: string
-                        description: The user's profile picture base64 string
+                        description: The user's profile picture base64 string, or URL with media=url
+                    profile_picture_id:
+                        type: integer
+                        description: The user's profile picture media ID
                     dark_mode:
                         type: boolean
                         description: Whether the user has dark mode enabled
@@ -212,8 +1025,8 @@ def api_login():
     if user.password != password:
         return {'message': 'Incorrect password'}, 401
     user.api_key = gen_api_key()
-    profile_picture = session.query(Media).filter(Media.id == user.media_id).first()
     session.commit()
+    auth_cache.invalidate_user(username)
     ret = {
         'first_name': user.first_name,
         'last_name': user.last_name,
@@ -221,14 +1034,15 @@ def api_login():
         'dark_mode': user.dark_mode,
         'profanity_filter': user.profanity_filter,
         'ui_scale': user.ui_scale,
-        'profile_picture': profile_picture.base64 if profile_picture is not None else None,
+        'profile_picture_id': user.media_id,
         'api_key': user.api_key
     }
+    attach_media(session, [ret], [('profile_picture_id', 'profile_picture')])
     session.close()
     return ret
 
 @app.route('/api/change_password', methods=['PATCH'])
-@recreates_engine()
+@reconnects_engine()
 def api_change_password():
     """
     Endpoint to change a user's password.
@@ -266,17 +1080,18 @@ def api_change_password():
     data = request.get_json()
     username, api_key, password, new_password = data['username'], data['api_key'], data['password'], data['new_password']
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.username == username).filter(User.api_key == api_key).filter(User.password == password).first()
-    if user is None:
+    user = find_user(session, username, api_key)
+    if user is None or user.password != password:
         return {'message': 'User/Password/API key not found'}, 401
     user.password = new_password
     user.api_key = gen_api_key()
     session.commit()
+    auth_cache.invalidate_user(username)
     session.close()
     return {'message': 'Password changed'}
 
 @app.route('/api/logout', methods=['POST'])
-@recreates_engine()
+@reconnects_engine()
 def api_logout():
     """
     Endpoint to logout.
@@ -306,16 +1121,17 @@ def api_logout():
     data = request.get_json()
     username, api_key = data['username'], data['api_key']
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.username == username).filter(User.api_key == api_key).first()
+    user = find_user(session, username, api_key)
     if user is None:
         return {'message': 'User/API key not found'}, 401
     user.api_key = None
     session.commit()
+    auth_cache.invalidate_user(username)
     session.close()
     return {'message': 'User logged out'}
 
 @app.route('/api/user', methods=['PUT'])
-@recreates_engine()
+@reconnects_engine()
 def create_user():
     """
     Endpoint to create a user
@@ -365,21 +1181,23 @@ def create_user():
         existing_email = session.query(User).filter(User.email == data['email']).first()
         if existing_email:
             return {'message': 'Email already exists'}, 416
-        session.add(User(
+        user_id = session.execute(insert(User.__table__).values(
             first_name=data['first_name'],
             last_name=data['last_name'],
             email=data['email'],
             username=data['username'],
             password=data['password']
-        ))
+        )).inserted_primary_key[0]
         session.commit()
+        author = (user_id, data['username'], data['first_name'], data['last_name'])
         session.close()
+        update_search_index(lambda index: index.set_author(*author))
     except KeyError:
         return {'message': 'Missing required fields'}, 400
     return {'message': 'User created'}, 201
 
 @app.route('/api/user', methods=['PATCH'])
-@recreates_engine()
+@reconnects_engine()
 def update_user():
     """
     Endpoint to update a user
@@ -429,7 +1247,7 @@ def update_user():
     data = request.get_json()
     session = scoped_session(sessionFactory)
     try:
-        user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+        user = find_user(session, data['username'], data['api_key'])
         if user is None:
             return {'message': 'User/API key not found'}, 401
         user.first_name = data['first_name'] if 'first_name' in data else user.first_name
@@ -439,16 +1257,22 @@ def update_user():
         user.ui_scale = data['ui_scale'] if 'ui_scale' in data else user.ui_scale
         user.media_id = data['profile_picture_media_id'] if 'profile_picture_media_id' in data else user.media_id
         session.commit()
+        auth_cache.invalidate_user(data['username'])
+        author = (user.id, user.username, user.first_name, user.last_name)
+        if feed_cache is not None:
+            feed_cache.author_changed(user.username, first_name=user.first_name, last_name=user.last_name, profile_picture_id=user.media_id)
         session.close()
+        update_search_index(lambda index: index.set_author(*author))
     except KeyError:
         return {'message': 'Missing required fields'}, 400
     return {'message': 'User updated'}, 200
 
 @app.route('/api/user', methods=['GET'])
-@recreates_engine()
+@reconnects_engine()
+@reads_from_replica()
 def get_user():
     """
-    Endpoint to get the users list. For Debugging!
+    Endpoint to get the users list. For Debugging! The list is streamed with chunked transfer.
     ---
     tags:
       - User
@@ -487,23 +1311,32 @@ def get_user():
                         description: The user's API key
     """
     session = scoped_session(sessionFactory)
-    users = session.query(User).all()
-    ret = [{
-            'first_name': user.first_name,
-            'last_name': user.last_name,
-            'username': user.username,
-            'email': user.email,
-            'dark_mode': user.dark_mode,
-            'profanity_filter': user.profanity_filter,
-            'ui_scale': user.ui_scale,
-            'password': user.password,
-            'api_key': user.api_key
-        } for user in users]
-    session.close()
-    return ret
+    def users():
+        try:
+            # yield_per reads through a server-side cursor, so memory stays flat whatever the table size.
+            for user in session.execute(
+                    select(User.first_name, User.last_name, User.username, User.email, User.dark_mode,
+                           User.profanity_filter, User.ui_scale, User.password, User.api_key)
+                        .execution_options(yield_per=env_int('USER_STREAM_BATCH', 500))
+                ):
+                yield {
+                    'first_name': user.first_name,
+                    'last_name': user.last_name,
+                    'username': user.username,
+                    'email': user.email,
+                    'dark_mode': user.dark_mode,
+                    'profanity_filter': user.profanity_filter,
+                    'ui_scale': user.ui_scale,
+                    'password': user.password,
+                    'api_key': user.api_key
+                }
+        finally:
+            session.close()
+    return streamed_json_array(users(), app.json.dumps)
 
 @app.route('/api/user/<int:user_id>', methods=['GET'])
-@recreates_engine()
+@reconnects_engine()
+@reads_from_replica()
 def get_user_by_id(user_id):
     """
     Endpoint to get simple info about a user by ID
@@ -516,6 +1349,16 @@ def get_user_by_id(user_id):
           type: integer
           required: true
           description: The user's ID
+        - in: query
+          name: media
+          type: string
+          required: false
+          description: When set to url, media fields hold /api/media URLs instead of inline base64 strings
+        - in: header
+          name: If-None-Match
+          type: string
+          required: false
+          description: The ETag of a cached copy
     responses:
         200:
             description: User found
@@ -533,26 +1376,120 @@ def get_user_by_id(user_id):
                         description: The user's username
                     profile_picture:
                         type: string
-                        description: The user's profile picture base64 string
+                        description: The user's profile picture base64 string, or URL with media=url
+                    profile_picture_id:
+                        type: integer
+                        description: The user's profile picture media ID
+        304:
+            description: The cached copy is current
         404:
             description: User not found
     """
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.id == user_id).first()
+    user = session.execute(select(User.first_name, User.last_name, User.username, User.media_id).where(User.id == user_id)).first()
     if user is None:
         return {'message': 'User not found'}, 404
-    profile_picture = session.query(Media).filter(Media.id == user.media_id).first()
     ret = {
         'first_name': user.first_name,
         'last_name': user.last_name,
         'username': user.username,
-        'profile_picture': profile_picture.base64 if profile_picture is not None else None
+        'profile_picture_id': user.media_id
     }
+    etag = payload_etag(ret)
+    if request.if_none_match.contains_weak(etag):
+        session.close()
+        return not_modified(etag)
+    attach_media(session, [ret], [('profile_picture_id', 'profile_picture')])
     session.close()
-    return ret
+    response = make_response(ret)
+    response.set_etag(etag, weak=True)
+    return response
+
+@app.route('/api/users', methods=['GET'])
+@reconnects_engine()
+@reads_from_replica()
+def get_users_by_ids():
+    """
+    Endpoint to get simple info about many users by ID in one request
+    ---
+    tags:
+      - User
+    parameters:
+        - in: query
+          name: ids
+          type: string
+          required: true
+          description: Comma separated user IDs; at most 100
+        - in: query
+          name: media
+          type: string
+          required: false
+          description: When set to url, media fields hold /api/media URLs instead of inline base64 strings
+        - in: header
+          name: If-None-Match
+          type: string
+          required: false
+          description: The ETag of a cached copy
+    responses:
+        200:
+            description: The users found, in the requested order
+            schema:
+                id: UserList
+                properties:
+                    id:
+                        type: integer
+                        description: The user's ID
+                    first_name:
+                        type: string
+                        description: The user's first name
+                    last_name:
+                        type: string
+                        description: The user's last name
+                    username:
+                        type: string
+                        description: The user's username
+                    profile_picture:
+                        type: string
+                        description: The user's profile picture base64 string, or URL with media=url
+                    profile_picture_id:
+                        type: integer
+                        description: The user's profile picture media ID
+        304:
+            description: The cached copy is current
+        400:
+            description: Missing, invalid or too many IDs
+    """
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for ids in request.args.getlist('ids') for user_id in ids.split(',') if user_id.strip()))
+    except ValueError:
+        return {'message': 'Invalid IDs'}, 400
+    if not user_ids:
+        return {'message': 'Missing required fields'}, 400
+    if len(user_ids) > USER_BATCH_MAX:
+        return {'message': f'At most {USER_BATCH_MAX} IDs per request'}, 400
+    session = scoped_session(sessionFactory)
+    users = {user.id: user for user in session.execute(
+        select(User.id, User.first_name, User.last_name, User.username, User.media_id).where(User.id.in_(user_ids))
+    )}
+    ret = [{
+        'id': user.id,
+        'first_name': user.first_name,
+        'last_name': user.last_name,
+        'username': user.username,
+        'profile_picture_id': user.media_id
+    } for user in (users[user_id] for user_id in user_ids if user_id in users)]
+    etag = payload_etag(ret)
+    if request.if_none_match.contains_weak(etag):
+        session.close()
+        return not_modified(etag)
+    attach_media(session, ret, [('profile_picture_id', 'profile_picture')])
+    session.close()
+    response = make_response(ret)
+    response.set_etag(etag, weak=True)
+    return response
 
 @app.route('/api/post', methods=['PUT'])
-@recreates_engine()
+@reconnects_engine()
 def create_post():
     """
     Endpoint to create a post
@@ -591,23 +1528,238 @@ def create_post():
     data = request.get_json()
     session = scoped_session(sessionFactory)
     try:
-        user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+        user = authenticate(session, data['username'], data['api_key'])
         if user is None:
             return {'message': 'User/API key not found'}, 401
-        session.add(Post(
+        # A Core insert: the new id comes back as the cursor's lastrowid, without reloading the row.
+        post_id = session.execute(insert(Post.__table__).values(
             content=data['content'],
             author_id=user.id,
             Media_id=data['media_id'] if 'media_id' in data else None
-        ))
+        )).inserted_primary_key[0]
         session.commit()
-        post_id = session.query(Post).filter(Post.content == data['content']).first().id
+        if feed_cache is not None:
+            created = session.execute(feed_query().where(Post.id == post_id)).first()
+            if created is not None:
+                feed_cache.post_added((created.penalized_created_at, created.post_id), feed_row(created))
         session.close()
+        update_search_index(lambda index: index.add_post(post_id, user.id, data['content']))
         return {'message': 'Post created', 'id': post_id}, 201
     except KeyError:
         return {'message': 'Missing required fields'}, 400
     
+def feed_query(viewer_id=None):
+    """
+    Builds the ranked feed as a single statement: author fields are joined in, the downvote count and
+    ranking are read from the post row, and the viewer's downvote is a primary key lookup.
+    Media is referenced by id and loaded for the whole page by attach_media.
+    """
+    is_downvoted = false() if viewer_id is None else downvoted_by(viewer_id)
+    posts = select(
+            Post.id.label('post_id'),
+            Post.content,
+            User.first_name,
+            User.last_name,
+            User.username,
+            User.media_id.label('profile_picture_id'),
+            Post.Media_id.label('media_id'),
+            Post.downvote_count.label('downvotes'),
+            is_downvoted.label('is_downvoted'),
+            Post.created_at,
+            Post.updated_at,
+            Post.penalized_created_at
+        ).select_from(Post) \
+        .join(User, User.id == Post.author_id) \
+        .order_by(desc(Post.penalized_created_at), desc(Post.id))
+    return posts
+
+SEARCH_MAX_RESULTS = env_int('SEARCH_MAX_RESULTS', 1000)
+SEARCH_INDEX_REFRESH = env_int('SEARCH_INDEX_REFRESH', 10)
+# Ids are allocated before commit, so rows can commit out of id order; each catch-up re-reads this many ids.
+SEARCH_INDEX_OVERLAP = 100
+
+_post_search_index = None
+# Changes made while the index is loading, replayed onto it once loaded.
+_post_search_changes = None
+# The highest post and user ids read into the index, and when it last caught up on them.
+_post_search_seen = (0, 0)
+_post_search_refreshed_at = 0
+_post_search_lock = threading.Lock()
+
+def load_search_index(session, index, after_post_id=0, after_user_id=0):
+    """
+    Adds the posts and users with ids above the given ones to the index, and returns the highest ids read.
+    """
+    last_post_id, last_user_id = after_post_id, after_user_id
+    for post in session.execute(select(Post.id, Post.author_id, Post.content).where(Post.id > after_post_id)):
+        index.add_post(*post)
+        last_post_id = max(last_post_id, post.id)
+    for author in session.execute(select(User.id, User.username, User.first_name, User.last_name).where(User.id > after_user_id)):
+        index.set_author(*author)
+        last_user_id = max(last_user_id, author.id)
+    return last_post_id, last_user_id
+
+def post_search_index(session):
+    """
+    Loads the in-process search index on first use. Changes made by this process are applied by
+    update_search_index; posts and users created by other workers or by `flask import` are read every
+    SEARCH_INDEX_REFRESH seconds. The loads run outside the lock, so requests waiting on them don't
+    hold up the others.
+    """
+    global _post_search_index, _post_search_changes, _post_search_seen, _post_search_refreshed_at
+    with _post_search_lock:
+        index = _post_search_index
+        if index is not None and time.monotonic() - _post_search_refreshed_at < SEARCH_INDEX_REFRESH:
+            return index
+        if index is not None:
+            # Only one request catches up; the others keep searching the index as it is.
+            _post_search_refreshed_at = time.monotonic()
+            after = [max(seen - SEARCH_INDEX_OVERLAP, 0) for seen in _post_search_seen]
+        elif _post_search_changes is None:
+            _post_search_changes = []
+    if index is not None:
+        seen = load_search_index(session, index, *after)
+        with _post_search_lock:
+            _post_search_seen = tuple(map(max, _post_search_seen, seen))
+        return index
+    index = PostSearchIndex()
+    seen = load_search_index(session, index)
+    with _post_search_lock:
+        if _post_search_index is None:
+            for change in _post_search_changes:
+                change(index)
+            _post_search_index, _post_search_changes = index, None
+            _post_search_seen, _post_search_refreshed_at = seen, time.monotonic()
+        return _post_search_index
+
+def update_search_index(change):
+    with _post_search_lock:
+        if _post_search_changes is not None:
+            _post_search_changes.append(change)
+        index = _post_search_index
+    if index is not None:
+        change(index)
+
+def search_post_ids(session, query):
+    """
+    Returns the ids of the posts matching query by content or by author, best match first.
+    MySQL answers from the FULLTEXT indexes on posts and users, other databases from the in-process index.
+    """
+    if sql.dialect.name != 'mysql':
+        return post_search_index(session).search(query, SEARCH_MAX_RESULTS)
+    content_match = match(Post.content, against=query).in_natural_language_mode()
+    author_match = match(User.username, User.first_name, User.last_name, against=query).in_natural_language_mode()
+    matches = union_all(
+        select(Post.id.label('post_id'), content_match.label('score')).where(content_match),
+        select(Post.id.label('post_id'), author_match.label('score')).join(User, User.id == Post.author_id).where(author_match)
+    ).subquery('matches')
+    score = func.sum(matches.c.score)
+    return session.scalars(
+        select(matches.c.post_id).group_by(matches.c.post_id)
+            .order_by(desc(score), desc(matches.c.post_id)).limit(SEARCH_MAX_RESULTS)
+    ).all()
+
+# The (count, max id) version misses words edited in place; BAD_WORDS_MAX_AGE bounds how long they go unseen.
+profanity_filters = ProfanityFilterCache(ttl=env_int('BAD_WORDS_TTL', 60), max_age=env_int('BAD_WORDS_MAX_AGE', 600))
+
+def load_profanity_filter(session):
+    return profanity_filters.get(
+        lambda: tuple(session.execute(select(func.count(Bad_Words.id), func.max(Bad_Words.id))).one()),
+        lambda: session.scalars(select(Bad_Words.word)).all()
+    )
+
+def mask_profanity(session, rows, profanity_filter=None):
+    """
+    Masks the content of a page of feed rows in place with this process's compiled bad words list.
+    """
+    if profanity_filter is None:
+        profanity_filter = load_profanity_filter(session)
+    for row, content in zip(rows, profanity_filter.mask_all([row['content'] for row in rows])):
+        row['content'] = content
+
+feed_cache = FeedCache(size=env_int('FEED_CACHE_SIZE', 0), ttl=env_int('FEED_CACHE_TTL', 5)) if env_int('FEED_CACHE_SIZE', 0) > 0 else None
+
+def load_feed_cache(session, size):
+    return [((post.penalized_created_at, post.post_id), feed_row(post)) for post in session.execute(feed_query().limit(size))]
+
+def mark_downvoted(session, user_id, rows, downvoted=None):
+    """
+    Sets is_downvoted on viewer-independent feed rows, such as the feed cache's, from the viewer's
+    downvote index when given, otherwise with one lookup limited to the rows.
+    """
+    if downvoted is not None:
+        for row in rows:
+            row['is_downvoted'] = contains(downvoted, row['post_id'])
+        return rows
+    post_ids = [row['post_id'] for row in rows]
+    downvoted = set(session.scalars(select(Downvote.post_id).where(Downvote.user_id == user_id).where(Downvote.post_id.in_(post_ids)))) if post_ids else set()
+    for row in rows:
+        row['is_downvoted'] = row['post_id'] in downvoted
+    return rows
+
+# Above this many downvotes, dislikes_only joins the downvotes index instead of listing the ids.
+DISLIKES_IN_MAX = 1000
+
+FEED_STREAM_MAX_LIMIT = env_int('FEED_STREAM_MAX_LIMIT', 200)
+FEED_STREAM_CHUNK = env_int('FEED_STREAM_CHUNK', 20)
+
+def stream_feed(session, rows):
+    """
+    Yields the feed rows with their media attached a chunk at a time, so only one chunk of media is held in memory.
+    """
+    try:
+        while rows:
+            chunk = rows[:FEED_STREAM_CHUNK]
+            del rows[:FEED_STREAM_CHUNK]
+            yield from attach_media(session, chunk, FEED_MEDIA_FIELDS)
+    finally:
+        session.close()
+
+def encode_cursor(penalized_created_at, post_id):
+    payload = json.dumps([penalized_created_at.isoformat(), post_id]).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Returns the (penalized_created_at, post_id) pair encoded by encode_cursor, or raises ValueError.
+    """
+    try:
+        penalized_created_at, post_id = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        return datetime.fromisoformat(penalized_created_at), int(post_id)
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError) as error:
+        raise ValueError('Invalid cursor') from error
+
+def feed_after(posts, penalized_created_at, post_id):
+    """
+    Restricts the feed to the posts ranked after a decoded cursor, so any page costs the same as the first.
+    """
+    return posts.where(tuple_(Post.penalized_created_at, Post.id) < tuple_(penalized_created_at, post_id))
+
+FEED_MEDIA_FIELDS = [('profile_picture_id', 'profile_picture'), ('media_id', 'media')]
+app.json.register_rows(
+    ['post_id', 'content', 'first_name', 'last_name', 'username', 'profile_picture_id', 'media_id', 'downvotes',
+     'is_downvoted', 'created_at', 'updated_at', 'profile_picture', 'media'],
+    date_fields=['created_at', 'updated_at']
+)
+
+def feed_row(post):
+    return {
+        'post_id': post.post_id,
+        'content': post.content,
+        'first_name': post.first_name,
+        'last_name': post.last_name,
+        'username': post.username,
+        'profile_picture_id': post.profile_picture_id,
+        'media_id': post.media_id,
+        'downvotes': post.downvotes,
+        'is_downvoted': bool(post.is_downvoted),
+        'created_at': post.created_at,
+        'updated_at': post.updated_at
+    }
+
 @app.route('/api/post', methods=['GET'])
-@recreates_engine()
+@reconnects_engine()
+@reads_from_replica()
 def get_posts():
     """
     Endpoint to get the posts list.
@@ -631,12 +1783,22 @@ def get_posts():
           name: offset
           type: integer
           required: false
-          description: The number of posts to skip; defaults to 0
+          description: The number of posts to skip; defaults to 0; ignored when a cursor is provided
+        - in: query
+          name: cursor
+          type: string
+          required: false
+          description: The X-Next-Cursor header of the previous page; continues the feed after its last post
         - in: query
           name: limit
           type: integer
           required: false
-          description: The number of posts to return; defaults to 10; max 20
+          description: The number of posts to return; defaults to 10; max 20, or FEED_STREAM_MAX_LIMIT (200) when streaming
+        - in: query
+          name: stream
+          type: boolean
+          required: false
+          description: When provided, the page is streamed with chunked transfer, loading its media a chunk of posts at a time
         - in: query
           name: dislikes_only
           type: boolean
@@ -646,10 +1808,20 @@ def get_posts():
           name: search
           type: string
           required: false
-          description: When provided, only posts or users containing the search string will be returned; case insensitive
+          description: When provided, only posts whose content or author matches the search words will be returned, best match first; case insensitive; paged with offset
+        - in: query
+          name: media
+          type: string
+          required: false
+          description: When set to url, media fields hold /api/media URLs instead of inline base64 strings
+        - in: header
+          name: If-None-Match
+          type: string
+          required: false
+          description: The ETag of a cached copy of the page
     responses:
         200:
-            description: Post list
+            description: Post list. When the page is full, the X-Next-Cursor header holds the cursor of the next page.
             schema:
                 id: FullPost
                 properties:
@@ -670,7 +1842,16 @@ def get_posts():
                         description: The user's username
                     profile_picture:
                         type: string
-                        description: The user's profile picture base64 string
+                        description: The user's profile picture base64 string, or URL with media=url
+                    profile_picture_id:
+                        type: integer
+                        description: The user's profile picture media ID
+                    media:
+                        type: string
+                        description: The post media base64 string, or URL with media=url
+                    media_id:
+                        type: integer
+                        description: The post media ID
                     downvotes:
                         type: integer
                         description: The number of downvotes
@@ -683,6 +1864,10 @@ def get_posts():
                     updated_at:
                         type: string
                         description: The post last update date
+        304:
+            description: The cached copy of the page is current
+        400:
+            description: Invalid cursor
         401:
             description: User/API key not found
         500:
@@ -690,45 +1875,82 @@ def get_posts():
     """
     data = request.args
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+    user = authenticate(session, data['username'], data['api_key'])
     if user is None:
         return {'message': 'User/API key not found'}, 401
-    profanity_filter = user.profanity_filter
     offset = int(data['offset']) if 'offset' in data else 0
-    limit = max(min(int(data['limit']), 20), 1) if 'limit' in data else 10
-    posts = session.query(
-            Post,
-            func.coalesce(
-                literal_column("TIMESTAMPADD(DAY, -COUNT(downvotes.user_id), posts.created_at)"),
-                Post.created_at
-            ).label('penalized_created_at')
-        ).outerjoin(Downvote, Downvote.post_id == Post.id).group_by(Post.id)
+    limit = max(min(int(data['limit']), FEED_STREAM_MAX_LIMIT if 'stream' in data else 20), 1) if 'limit' in data else 10
+    after = None
+    if 'cursor' in data and 'search' not in data:
+        try:
+            after = decode_cursor(data['cursor'])
+        except ValueError:
+            return {'message': 'Invalid cursor'}, 400
+    downvoted, profanity_filter = concurrently(
+        session,
+        lambda session: viewer_downvotes(session, user.id),
+        lambda session: load_profanity_filter(session) if user.profanity_filter else None
+    )
+    posts = feed_query(user.id if downvoted is None else None)
+    cached = None
     if 'search' in data:
-        posts = posts.filter(Post.content.ilike(f'%{data["search"]}%'))
+        post_ids = search_post_ids(session, data['search'])
+        if 'dislikes_only' in data and downvoted is not None:
+            post_ids = [post_id for post_id in post_ids if contains(downvoted, post_id)]
+        elif 'dislikes_only' in data and post_ids:
+            disliked = set(session.scalars(select(Downvote.post_id).where(Downvote.user_id == user.id).where(Downvote.post_id.in_(post_ids))))
+            post_ids = [post_id for post_id in post_ids if post_id in disliked]
+        rank = {post_id: position for position, post_id in enumerate(post_ids[offset:offset + limit])}
+        # Sorted by search rank below, so the feed order isn't needed.
+        posts = session.execute(posts.where(Post.id.in_(rank)).order_by(None)).all() if rank else []
+        posts.sort(key=lambda post: rank[post.post_id])
+    else:
+        if feed_cache is not None and 'dislikes_only' not in data:
+            cached = feed_cache.page(lambda size: load_feed_cache(session, size), limit, offset, after)
+        if 'dislikes_only' in data:
+            if downvoted is not None and len(downvoted) <= DISLIKES_IN_MAX:
+                posts = posts.where(Post.id.in_(list(downvoted)))
+            else:
+                posts = posts.where(downvoted_by(user.id))
+        if after is not None:
+            posts = feed_after(posts, *after)
+        else:
+            posts = posts.offset(offset)
+        if cached is None:
+            posts = session.execute(posts.limit(limit)).all()
+    if cached is not None:
+        keys, ret = cached
+        mark_downvoted(session, user.id, ret, downvoted)
+    else:
+        keys = [(post.penalized_created_at, post.post_id) for post in posts]
+        ret = [feed_row(post) for post in posts]
+        if downvoted is not None:
+            mark_downvoted(session, user.id, ret, downvoted)
+    ret = overlay_queued_downvotes(user.id, ret)
     if 'dislikes_only' in data:
-        posts = posts.filter(Downvote.user_id == user.id)
-    posts = posts.order_by(desc('penalized_created_at')).offset(offset).limit(limit).all()
-    bad_word_list = []
-    if profanity_filter:
-        bad_word_list = [bad.word for bad in session.query(Bad_Words).all()]
-    ret = [{
-        'post_id': post[0].id,
-        'content': post[0].content if not profanity_filter else ' '.join(['***' if word.lower() in bad_word_list else word for word in post[0].content.split(' ')]),
-        'first_name': post[0].author.first_name,
-        'last_name': post[0].author.last_name,
-        'username': post[0].author.username,
-        'profile_picture': session.query(Media).filter(Media.id == post[0].author.media_id).first().base64 if post[0].author.media_id is not None else None,
-        'media': session.query(Media).filter(Media.id == post[0].Media_id).first().base64 if post[0].Media_id is not None else None,
-        'downvotes': session.query(Downvote).filter(Downvote.post_id == post[0].id).count(),
-        'is_downvoted': session.query(Downvote).filter(Downvote.post_id == post[0].id).filter(Downvote.user_id == user.id).first() is not None,
-        'created_at': post[0].created_at,
-        'updated_at': post[0].updated_at
-    } for post in posts]
-    session.close()
-    return ret
+        ret = [row for row in ret if row['is_downvoted']]
+    if profanity_filter is not None:
+        mask_profanity(session, ret, profanity_filter)
+    headers = {}
+    if 'search' not in data and len(keys) == limit:
+        headers['X-Next-Cursor'] = encode_cursor(*keys[-1])
+    etag = payload_etag(ret)
+    last_modified = max((row['updated_at'] for row in ret if row['updated_at'] is not None), default=None)
+    if request.if_none_match.contains_weak(etag):
+        session.close()
+        return not_modified(etag, last_modified, headers)
+    if 'stream' in data:
+        response = streamed_json_array(stream_feed(session, ret), app.json.dumps, headers=headers)
+    else:
+        attach_media(session, ret, FEED_MEDIA_FIELDS)
+        session.close()
+        response = make_response(ret, 200, headers)
+    response.set_etag(etag, weak=True)
+    response.last_modified = last_modified
+    return response
 
 @app.route('/api/post/downvote/<int:post_id>', methods=['PUT', 'DELETE'])
-@recreates_engine()
+@reconnects_engine()
 def create_downvote(post_id):
     """
     Endpoint to modify a post's downvote status
@@ -767,30 +1989,113 @@ def create_downvote(post_id):
     """
     data = request.get_json()
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+    user = authenticate(session, data['username'], data['api_key'])
     if user is None:
         return {'message': 'User/API key not found'}, 401
-    post = session.query(Post).filter(Post.id == post_id).first()
-    if post is None:
+    if downvote_queue is not None:
+        if session.scalar(select(Post.id).where(Post.id == post_id)) is None:
+            return {'message': 'Post not found'}, 404
+        session.close()
+        downvote_queue.enqueue(post_id, user.id, request.method == 'PUT')
+        if request.method == 'PUT':
+            return {'message': 'Downvote created'}, 201
+        return {'message': 'Downvote deleted'}, 200
+    created, deleted, missing = apply_downvotes(session, {(post_id, user.id): request.method == 'PUT'})
+    if missing:
         return {'message': 'Post not found'}, 404
-    exists = session.query(Downvote).filter(Downvote.post_id == post_id).filter(Downvote.user_id == user.id).first()
+    session.commit()
+    session.close()
     if request.method == 'PUT':
-        if exists is None:
-            session.add(Downvote(
-                post_id=post_id,
-                user_id=user.id
-            ))
-            session.commit()
-            session.close()
         return {'message': 'Downvote created'}, 201
-    elif exists is not None and request.method == 'DELETE':
-        session.delete(exists)
-        session.commit()
-        session.close()
-        return {'message': 'Downvote deleted'}, 200
-    
+    return {'message': 'Downvote deleted'}, 200
+
+@app.route('/api/post/downvotes', methods=['POST'])
+@reconnects_engine()
+def apply_downvote_batch():
+    """
+    Endpoint to modify the downvote status of many posts at once, in one transaction
+    ---
+    tags:
+      - Post
+    requestBody:
+        content:
+            application/json:
+                schema:
+                    required:
+                        - username
+                        - api_key
+                        - downvotes
+                    properties:
+                        username:
+                            type: string
+                            description: The user's username
+                        api_key: 
+                            type: string
+                            description: The user's API key
+                        downvotes:
+                            type: array
+                            description: The changes, applied in order; the last one for a post wins
+                            items:
+                                type: object
+                                properties:
+                                    post_id:
+                                        type: integer
+                                        description: The post's ID
+                                    action:
+                                        type: string
+                                        description: PUT to downvote the post, DELETE to remove the downvote
+    responses:
+        200:
+            description: Downvotes applied
+            schema:
+                id: DownvoteBatch
+                properties:
+                    created:
+                        type: array
+                        description: The IDs of the posts that were downvoted
+                    deleted:
+                        type: array
+                        description: The IDs of the posts whose downvote was removed
+                    not_found:
+                        type: array
+                        description: The IDs of the posts that don't exist
+        400:
+            description: Missing required fields, invalid or too many downvotes
+        401:
+            description: User/API key not found
+    """
+    data = request.get_json()
+    session = scoped_session(sessionFactory)
+    try:
+        user = authenticate(session, data['username'], data['api_key'])
+        if user is None:
+            return {'message': 'User/API key not found'}, 401
+        if len(data['downvotes']) > DOWNVOTE_BATCH_MAX:
+            return {'message': f'At most {DOWNVOTE_BATCH_MAX} downvotes per request'}, 400
+        intents = {}
+        for downvote in data['downvotes']:
+            action = downvote['action'].upper()
+            if action not in ('PUT', 'DELETE'):
+                return {'message': 'Invalid downvotes'}, 400
+            intents[(int(downvote['post_id']), user.id)] = action == 'PUT'
+    except KeyError:
+        return {'message': 'Missing required fields'}, 400
+    except (AttributeError, TypeError, ValueError):
+        return {'message': 'Invalid downvotes'}, 400
+    if downvote_queue is not None:
+        downvote_queue.discard(intents)
+    created, deleted, missing = apply_downvotes(session, intents)
+    session.commit()
+    session.close()
+    return {
+        'message': 'Downvotes applied',
+        'created': [post_id for post_id, _ in created],
+        'deleted': [post_id for post_id, _ in deleted],
+        'not_found': missing
+    }
+
 @app.route('/api/media', methods=['PUT'])
-@recreates_engine()
+@reconnects_engine()
 def create_media():
     """
     Endpoint to create a media
@@ -819,31 +2124,118 @@ def create_media():
         201:
             description: Media created
         400:
-            description: Missing required fields
+            description: Missing required fields, invalid base64, or not a PNG, JPEG, GIF or WebP image
         401:
             description: User/API key not found
     """
     data = request.get_json()
     session = scoped_session(sessionFactory)
     try:
-        user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+        user = authenticate(session, data['username'], data['api_key'])
         if user is None:
             return {'message': 'User/API key not found'}, 401
-        exists = session.query(Media).filter(cast(Media.base64, String) == data['base64']).first()
-        if not exists:
-            session.add(Media(
-                base64=data['base64'],
-                author_id=user.id
-            ))
-            session.commit()
-        media_id = session.query(Media).filter(cast(Media.base64, String) == data['base64']).first().id
+        try:
+            mime_type, content = decode_media(data['base64'])
+        except ValueError:
+            return {'message': 'Invalid base64'}, 400
+        try:
+            check_image(mime_type, content)
+        except ValueError as error:
+            return {'message': str(error)}, 400
+        digest = digest_media(content)
+        media_id = session.scalar(select(Media.id).where(Media.sha256 == digest))
+        if media_id is None:
+            if blob_store is not None:
+                blob_store.put(content)
+            try:
+                media_id = session.execute(insert(Media.__table__).values(
+                    base64=data['base64'] if blob_store is None else None,
+                    sha256=digest,
+                    mime_type=mime_type,
+                    size=len(content),
+                    author_id=user.id
+                )).inserted_primary_key[0]
+                session.commit()
+            except IntegrityError:
+                # The same bytes were uploaded concurrently; the unique digest keeps a single row.
+                session.rollback()
+                media_id = session.scalar(select(Media.id).where(Media.sha256 == digest))
         session.close()
         return {'message': 'Media created', 'id': media_id}, 201
     except KeyError:
         return {'message': 'Missing required fields'}, 400
 
+@app.route('/api/media/<int:media_id>', methods=['GET'])
+@reconnects_engine()
+def get_media(media_id):
+    """
+    Endpoint to get a media's bytes. Media never changes, so responses can be cached indefinitely.
+    ---
+    tags:
+      - Media
+    parameters:
+        - in: path
+          name: media_id
+          type: integer
+          required: true
+          description: The media's ID
+        - in: header
+          name: Range
+          type: string
+          required: false
+          description: A byte range of the media
+        - in: header
+          name: If-None-Match
+          type: string
+          required: false
+          description: The ETag of a cached copy
+    responses:
+        200:
+            description: The media's bytes, inline if they are a PNG, JPEG, GIF or WebP image and otherwise as an application/octet-stream attachment
+        206:
+            description: The requested byte range
+        304:
+            description: The cached copy is current
+        404:
+            description: Media not found
+        503:
+            description: The media is in the blob store, but MEDIA_STORE_PATH is not set
+    """
+    session = scoped_session(sessionFactory)
+    media = session.execute(select(Media.base64, Media.sha256).where(Media.id == media_id)).first()
+    session.close()
+    if media is None:
+        return {'message': 'Media not found'}, 404
+    if media.base64 is None:
+        content = stored_blobs().path(media.sha256)
+        with open(content, 'rb') as file:
+            head = file.read(SIGNATURE_SIZE)
+    else:
+        try:
+            _, head = decode_media(media.base64)
+        except ValueError:
+            # Uploaded before uploads were validated; downloaded as stored, like the feed inlines it.
+            head = media.base64.encode()
+        content = io.BytesIO(head)
+    # The type comes from the bytes, never the upload's claim, and only raster images are shown inline:
+    # anything else (legacy media uploaded before validation) downloads, so it can't run as a page on this origin.
+    mime_type = image_type(head)
+    response = send_file(
+        content,
+        mimetype=mime_type or 'application/octet-stream',
+        as_attachment=mime_type is None,
+        download_name=f'media-{media_id}',
+        conditional=True,
+        etag=media.sha256 or digest_media(content.getvalue()),
+        max_age=MEDIA_MAX_AGE
+    )
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
 @app.route('/api/post/<int:post_id>', methods=['DELETE'])
-@recreates_engine()
+@reconnects_engine()
 def delete_post(post_id):
     """
     Endpoint to delete a post
@@ -880,7 +2272,7 @@ def delete_post(post_id):
     """
     data = request.get_json()
     session = scoped_session(sessionFactory)
-    user = session.query(User).filter(User.username == data['username']).filter(User.api_key == data['api_key']).first()
+    user = authenticate(session, data['username'], data['api_key'])
     if user is None:
         return {'message': 'User/API key not found'}, 401
     post = session.query(Post).filter(Post.id == post_id).first()
@@ -889,11 +2281,312 @@ def delete_post(post_id):
     session.delete(post)
     session.commit()
     session.close()
+    update_search_index(lambda index: index.remove_post(post_id))
+    if feed_cache is not None:
+        feed_cache.post_removed(post_id)
     return {'message': 'Post deleted'}
 
 
 
 
+@app.cli.command('reconcile-downvotes')
+@click.option('--batch-size', default=1000, show_default=True, help='Posts per transaction.')
+def reconcile_downvotes(batch_size):
+    """
+    Rebuilds posts.downvote_count and posts.penalized_created_at from the downvotes table. Each batch of
+    posts is locked before its downvotes are counted, as apply_downvotes locks them, so downvotes applied
+    meanwhile wait for the batch instead of being overwritten by its counts.
+    """
+    session = scoped_session(sessionFactory)
+    last_id, checked, fixed = 0, 0, 0
+    while True:
+        posts = session.execute(
+            select(Post.id, Post.created_at, Post.downvote_count, Post.penalized_created_at)
+                .where(Post.id > last_id).order_by(Post.id).limit(batch_size).with_for_update()
+        ).all()
+        if not posts:
+            break
+        last_id = posts[-1].id
+        counts = dict(session.execute(
+            select(Downvote.post_id, func.count(Downvote.user_id))
+                .where(Downvote.post_id.between(posts[0].id, last_id)).group_by(Downvote.post_id)
+        ).all())
+        drifted = {
+            post.id: (post.created_at, counts.get(post.id, 0)) for post in posts
+            if post.downvote_count != counts.get(post.id, 0) or post.penalized_created_at != penalize(post.created_at, counts.get(post.id, 0))
+        }
+        write_downvote_counts(session, drifted)
+        session.commit()
+        checked += len(posts)
+        fixed += len(drifted)
+    session.close()
+    click.echo(f'Checked {checked} posts, fixed {fixed}')
+
+@app.cli.command('backfill-media-digests')
+@click.option('--batch-size', default=100, show_default=True, help='Media rows per transaction.')
+@click.option('--move-to-store', is_flag=True, help='Also move the bytes to the blob store configured by MEDIA_STORE_PATH.')
+@click.option('--merge-duplicates', is_flag=True, help='Point users and posts at the first copy of duplicated media and delete the others.')
+def backfill_media_digests(batch_size, move_to_store, merge_duplicates):
+    """
+    Computes media.sha256, mime_type and size for media uploaded before they existed.
+    With --move-to-store, media still held in media.base64 is moved to the blob store as well.
+    """
+    if move_to_store and blob_store is None:
+        raise click.UsageError('--move-to-store needs MEDIA_STORE_PATH')
+    session = scoped_session(sessionFactory)
+    last_id, digested, duplicates, invalid = 0, 0, 0, 0
+    while True:
+        pending = or_(Media.sha256.is_(None), Media.base64.is_not(None)) if move_to_store else Media.sha256.is_(None)
+        media = session.execute(
+            select(Media.id, Media.base64).where(Media.id > last_id).where(pending)
+                .order_by(Media.id).limit(batch_size)
+        ).all()
+        if not media:
+            break
+        last_id = media[-1].id
+        for item in media:
+            try:
+                mime_type, content = decode_media(item.base64)
+            except ValueError:
+                invalid += 1
+                continue
+            digest = digest_media(content)
+            original_id = session.scalar(select(Media.id).where(Media.sha256 == digest))
+            if original_id is not None and original_id != item.id:
+                duplicates += 1
+                if merge_duplicates:
+                    session.execute(update(User).where(User.media_id == item.id).values(media_id=original_id))
+                    session.execute(update(Post.__table__).where(Post.__table__.c.Media_id == item.id).values(Media_id=original_id, updated_at=Post.__table__.c.updated_at))
+                    session.execute(Media.__table__.delete().where(Media.__table__.c.id == item.id))
+                continue
+            values = {'sha256': digest, 'mime_type': mime_type, 'size': len(content)}
+            if move_to_store:
+                blob_store.put(content)
+                values['base64'] = None
+            session.execute(update(Media).where(Media.id == item.id).values(**values))
+            digested += 1
+        session.commit()
+    session.close()
+    click.echo(f'Digested {digested} media, {duplicates} duplicates{" merged" if merge_duplicates else " left without a digest"}, {invalid} not base64')
+
+def import_users(session, rows, usernames, progress):
+    """
+    Inserts users whose username and email are new. Their ids join usernames for the rows that follow.
+    """
+    valid = [row for row in rows if all(isinstance(row.get(field), str) for field in ('username', 'email', 'password'))]
+    progress.skip('missing fields', len(rows) - len(valid))
+    emails = set(session.scalars(select(User.email).where(User.email.in_({row['email'] for row in valid})))) if valid else set()
+    new, seen = [], set()
+    for row in valid:
+        if row['username'] in usernames or row['username'] in seen or row['email'] in emails:
+            progress.skip('existing username or email')
+            continue
+        seen.add(row['username'])
+        emails.add(row['email'])
+        new.append({field: row.get(field) for field in ('first_name', 'last_name', 'username', 'email', 'password')})
+    if new:
+        session.execute(insert(User.__table__), new)
+        usernames.update(session.execute(select(User.username, User.id).where(User.username.in_(seen))).all())
+    progress.imported += len(new)
+
+def import_media(session, rows, usernames, progress):
+    """
+    Inserts media whose bytes aren't stored yet; the unique SHA-256 digest finds copies in the database and in the batch.
+    """
+    decoded = {}
+    for row in rows:
+        author_id = usernames.get(row.get('username'))
+        if author_id is None:
+            progress.skip('unknown username')
+            continue
+        try:
+            mime_type, content = decode_media(row.get('base64'))
+        except ValueError:
+            progress.skip('invalid base64')
+            continue
+        try:
+            check_image(mime_type, content)
+        except ValueError:
+            progress.skip('not an image')
+            continue
+        digest = digest_media(content)
+        if digest in decoded:
+            progress.skip('duplicate media')
+            continue
+        decoded[digest] = (row['base64'], mime_type, content, author_id)
+    existing = set(session.scalars(select(Media.sha256).where(Media.sha256.in_(decoded)))) if decoded else set()
+    progress.skip('duplicate media', len(existing))
+    new = []
+    for digest, (value, mime_type, content, author_id) in decoded.items():
+        if digest in existing:
+            continue
+        if blob_store is not None:
+            blob_store.put(content)
+        new.append({'base64': value if blob_store is None else None, 'sha256': digest, 'mime_type': mime_type, 'size': len(content), 'author_id': author_id})
+    if new:
+        session.execute(insert(Media.__table__), new)
+    progress.imported += len(new)
+
+def import_posts(session, rows, usernames, progress):
+    """
+    Inserts posts by username. created_at (ISO 8601) backdates a post; media is a media_id, or the
+    media_sha256 of media imported before.
+    """
+    digests = {row['media_sha256'] for row in rows if isinstance(row.get('media_sha256'), str)}
+    media_by_digest = dict(session.execute(select(Media.sha256, Media.id).where(Media.sha256.in_(digests))).all()) if digests else {}
+    ids = {str(row['media_id']) for row in rows if row.get('media_id') is not None}
+    media_ids = set(session.scalars(select(Media.id).where(Media.id.in_([int(media_id) for media_id in ids if media_id.isdigit()])))) if ids else set()
+    # Rows without created_at take the database's defaults, which an insert can't mix with given values.
+    dated, undated = [], []
+    for row in rows:
+        author_id = usernames.get(row.get('username'))
+        content = row.get('content')
+        if author_id is None:
+            progress.skip('unknown username')
+            continue
+        if not isinstance(content, str) or len(content) > Post.content.type.length:
+            progress.skip('missing or too long content')
+            continue
+        media_id = None
+        if row.get('media_sha256') is not None:
+            media_id = media_by_digest.get(row['media_sha256'])
+        elif row.get('media_id') is not None and str(row['media_id']).isdigit() and int(row['media_id']) in media_ids:
+            media_id = int(row['media_id'])
+        if media_id is None and (row.get('media_sha256') is not None or row.get('media_id') is not None):
+            progress.skip('unknown media')
+            continue
+        post = {'content': content, 'author_id': author_id, 'Media_id': media_id}
+        if row.get('created_at'):
+            try:
+                created_at = datetime.fromisoformat(row['created_at'])
+            except (TypeError, ValueError):
+                progress.skip('invalid created_at')
+                continue
+            dated.append({**post, 'created_at': created_at, 'updated_at': created_at, 'penalized_created_at': created_at})
+        else:
+            undated.append(post)
+    for posts in (dated, undated):
+        if posts:
+            session.execute(insert(Post.__table__), posts)
+    progress.imported += len(dated) + len(undated)
+
+def import_downvotes(session, rows, usernames, progress):
+    """
+    Downvotes posts by post_id and username through apply_downvotes, so the posts' counts and ranking follow.
+    """
+    intents = {}
+    for row in rows:
+        user_id = usernames.get(row.get('username'))
+        try:
+            post_id = int(row['post_id'])
+        except (KeyError, TypeError, ValueError):
+            progress.skip('missing post_id')
+            continue
+        if user_id is None:
+            progress.skip('unknown username')
+            continue
+        if (post_id, user_id) in intents:
+            progress.skip('existing downvote')
+            continue
+        intents[(post_id, user_id)] = True
+    created, _, missing = apply_downvotes(session, intents)
+    missing = set(missing)
+    unknown = sum(1 for post_id, _ in intents if post_id in missing)
+    progress.skip('unknown post', unknown)
+    progress.skip('existing downvote', len(intents) - len(created) - unknown)
+    progress.imported += len(created)
+
+IMPORTERS = {'users': import_users, 'media': import_media, 'posts': import_posts, 'downvotes': import_downvotes}
+
+@app.cli.command('import')
+@click.argument('kind', type=click.Choice(list(IMPORTERS)))
+@click.argument('source', type=click.File('r', encoding='utf-8'))
+@click.option('--format', 'source_format', type=click.Choice(FORMATS), help='Input format; by default from the file extension, or NDJSON.')
+@click.option('--batch-size', default=1000, show_default=True, help='Rows per multi-row insert and per transaction.')
+def bulk_import(kind, source, source_format, batch_size):
+    """
+    Imports users, media, posts or downvotes from an NDJSON or CSV file (- for standard input), one row per
+    record with the fields of the matching API request, usernames standing in for user ids. Rows that
+    would duplicate existing data or can't be resolved are skipped and counted.
+
+    Running servers pick the new rows up as their caches expire.
+    """
+    progress = ImportProgress(kind)
+    session = scoped_session(sessionFactory)
+    usernames = dict(session.execute(select(User.username, User.id)).all())
+    session.commit()
+    try:
+        for batch in batches(read_rows(source, source_format or input_format(source.name)), batch_size):
+            IMPORTERS[kind](session, batch, usernames, progress)
+            session.commit()
+    except ValueError as error:
+        session.rollback()
+        raise click.ClickException(f'{error}. The batches before it were imported: {progress.summary()}')
+    finally:
+        session.close()
+    click.echo(progress.summary())
+
+MIGRATIONS_DIR = os.path.join(APP_ROOT, 'migrations')
+db_cli = AppGroup('db', help='Schema migrations, from the SQL files in migrations/.')
+app.cli.add_command(db_cli)
+
+@db_cli.command('upgrade')
+def db_upgrade():
+    """
+    Applies the migrations the database hasn't had yet. A database without the app's tables is created
+    from the models instead, which already include every migration, and they are all recorded as applied.
+    """
+    migrations = migration_files(MIGRATIONS_DIR)
+    with sql.begin() as connection:
+        applied = applied_versions(connection)
+    if not applied and not has_tables(sql, Base.metadata.tables):
+        with sql.begin() as connection:
+            Base.metadata.create_all(connection)
+            record(connection, [version for version, _ in migrations])
+        click.echo(f'Created the schema at migration {migrations[-1][0] if migrations else "none"}')
+        return
+    pending = [(version, path) for version, path in migrations if version not in applied]
+    for version, path in pending:
+        click.echo(f'Applying {os.path.basename(path)}')
+        apply(sql, version, path)
+    click.echo(f'Applied {len(pending)} migrations' if pending else 'Up to date')
+
+@db_cli.command('status')
+def db_status():
+    """
+    Lists the migrations and whether each has been applied.
+    """
+    with sql.begin() as connection:
+        applied = applied_versions(connection)
+    for version, path in migration_files(MIGRATIONS_DIR):
+        click.echo(f'{"applied" if version in applied else "pending":8} {os.path.basename(path)}')
+
+@db_cli.command('stamp')
+@click.argument('version')
+def db_stamp(version):
+    """
+    Records the migrations up to VERSION as applied without running them, for a database that was
+    migrated by hand before schema_migrations existed.
+    """
+    migrations = migration_files(MIGRATIONS_DIR)
+    if version not in {known for known, _ in migrations}:
+        raise click.BadParameter(f'No migration {version} in {MIGRATIONS_DIR}', param_hint='VERSION')
+    with sql.begin() as connection:
+        applied = applied_versions(connection)
+        stamped = [known for known, _ in migrations if int(known) <= int(version) and known not in applied]
+        record(connection, stamped)
+    click.echo(f'Recorded {len(stamped)} migrations as applied')
+
+@app.cli.command('build-openapi-spec')
+def build_openapi_spec():
+    """
+    Writes the OpenAPI spec to OPENAPI_SPEC_FILE, for workers to serve without building it.
+    """
+    started = time.perf_counter()
+    specs = {spec['endpoint']: Swagger.get_apispecs(swagger, spec['endpoint']) for spec in swagger.config['specs']}
+    write_openapi_spec(specs, source_digest())
+    click.echo(f'Wrote {OPENAPI_SPEC_FILE} in {time.perf_counter() - started:.2f} s')
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
     # app.run(ssl_context=('cert.pem', 'key.pem'), host='0.0.0.0')
@@ -0,0 +1,169 @@
+"""
+ASGI entry point, for serving the app from an event loop:
+
+    gunicorn -k uvicorn.workers.UvicornWorker asgi:application
+
+Routes in ASYNC_ENDPOINTS run the regular Flask handlers inside SQLAlchemy's asyncio bridge: their session
+is the sync facade of an AsyncSession on the async driver (aiomysql for MySQL, aiosqlite for SQLite), so
+while one request waits on the database the worker's event loop serves the others. What else they do that
+blocks, reading media from the blob store, compressing the response, flushing metrics snapshots and
+checking a lost connection, goes through app.off_loop, which runs it in a thread. Every other route runs
+on the sync engine in a thread, as it does under the WSGI entry point, app:app, which remains the
+fallback deployment.
+"""
+import asyncio
+import io
+import os
+import sys
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.util import await_only
+from werkzeug.exceptions import HTTPException
+
+import app as y
+
+# The hot read routes. Writes stay on the sync path, where row locks and uploads can't stall the loop.
+ASYNC_ENDPOINTS = {'get_posts', 'get_user', 'get_user_by_id', 'get_users_by_ids'}
+
+DRIVERS = {'mysql+pymysql': 'mysql+aiomysql', 'mysql': 'mysql+aiomysql', 'sqlite': 'sqlite+aiosqlite', 'sqlite+pysqlite': 'sqlite+aiosqlite'}
+
+def async_database_url():
+    if os.environ.get('ASYNC_DB_URL'):
+        return os.environ['ASYNC_DB_URL']
+    url = y.database_url()
+    scheme, separator, rest = url.partition('://')
+    return DRIVERS.get(scheme, scheme) + separator + rest
+
+async_engine = y.build_engine(async_database_url(), asynchronous=True)
+# Like the sync engine's in app.py: connections inherited through a fork belong to the parent.
+os.register_at_fork(after_in_child=lambda: async_engine.sync_engine.dispose(close=False))
+
+def build_environ(scope, body):
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode().decode('latin-1'),
+        'PATH_INFO': scope['path'].encode().decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False
+    }
+    server = scope.get('server') or ('localhost', 80)
+    environ['SERVER_NAME'], environ['SERVER_PORT'] = server[0], str(server[1] or 80)
+    if scope.get('client'):
+        environ['REMOTE_ADDR'], environ['REMOTE_PORT'] = scope['client'][0], str(scope['client'][1])
+    for name, value in scope['headers']:
+        name, value = name.decode('latin-1').upper().replace('-', '_'), value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = f'HTTP_{name}'
+        environ[name] = f'{environ[name]},{value}' if name in environ else value
+    # The body has been read whole, chunked or not.
+    environ['CONTENT_LENGTH'] = str(len(body))
+    return environ
+
+def run_wsgi(environ, send):
+    """
+    Runs the Flask app on environ, passing its response to send(message) as ASGI messages while it is produced.
+    """
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = int(status.split(' ', 1)[0])
+        response['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+    def start():
+        if not response.get('started'):
+            response['started'] = True
+            send({'type': 'http.response.start', 'status': response['status'], 'headers': response['headers']})
+
+    body = y.app(environ, start_response)
+    try:
+        for chunk in body:
+            if chunk:
+                start()
+                send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        start()
+        send({'type': 'http.response.body', 'body': b'', 'more_body': False})
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+def run_concurrently(loads):
+    """
+    Runs each load with the sync facade of its own AsyncSession and waits for all of them together.
+    Called from within the bridge, like the route that needs it.
+    """
+    async def run(load):
+        async with AsyncSession(async_engine) as session:
+            return await session.run_sync(load)
+    return await_only(asyncio.gather(*(run(load) for load in loads)))
+
+def run_in_thread(function, *args):
+    """
+    Runs a blocking call in a thread and waits for it without blocking the event loop. Called from within the bridge.
+    """
+    return await_only(asyncio.to_thread(function, *args))
+
+async def serve_in_event_loop(environ, send):
+    token = y.session_scope.set(object())
+    runner = y.blocking_runner.set(run_in_thread)
+    try:
+        async with AsyncSession(async_engine) as session:
+            def serve(sync_session):
+                sync_session.info['run_concurrently'] = run_concurrently
+                y.sessionFactory.registry.set(sync_session)
+                try:
+                    run_wsgi(environ, lambda message: await_only(send(message)))
+                finally:
+                    y.sessionFactory.registry.clear()
+            await session.run_sync(serve)
+    finally:
+        y.blocking_runner.reset(runner)
+        y.session_scope.reset(token)
+
+async def serve_in_thread(environ, send):
+    loop = asyncio.get_running_loop()
+    await asyncio.to_thread(run_wsgi, environ, lambda message: asyncio.run_coroutine_threadsafe(send(message), loop).result())
+
+def endpoint(environ):
+    try:
+        return y.app.url_map.bind_to_environ(environ).match()[0]
+    except HTTPException:
+        # Not found, wrong method and the like are answered by Flask on the sync path.
+        return None
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        chunks.append(message.get('body', b''))
+        if not message.get('more_body'):
+            return b''.join(chunks)
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await async_engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+    if scope['type'] != 'http':
+        return
+    body = await read_body(receive)
+    if body is None:
+        return
+    environ = build_environ(scope, body)
+    if endpoint(environ) in ASYNC_ENDPOINTS:
+        await serve_in_event_loop(environ, send)
+    else:
+        await serve_in_thread(environ, send)
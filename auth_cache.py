@@ -0,0 +1,60 @@
+"""
+Per-process cache of authenticated users, keyed on the SHA-256 digest of their API key.
+
+Entries expire after ttl seconds, and sooner when the user's generation changes. Generations are shared
+by the workers on the host (see shared_memory.Generations): key rotation and profile changes bump the
+user's generation, which every worker's entries for that user then no longer match.
+"""
+from collections import OrderedDict, namedtuple
+import hashlib
+import threading
+import time
+
+from shared_memory import Generations
+
+AuthenticatedUser = namedtuple('AuthenticatedUser', ['id', 'username', 'profanity_filter'])
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+class AuthCache:
+    def __init__(self, path, ttl=30, max_size=10000, slots=65536):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.generations = Generations(path, slots)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def generation(self, username):
+        """
+        The user's current generation. Read it before loading the user, and pass it to put().
+        """
+        return self.generations.get(username)
+
+    def get(self, digest):
+        with self.lock:
+            entry = self.entries.get(digest)
+            if entry is None:
+                return None
+            user, generation, expires_at = entry
+            if time.monotonic() >= expires_at or generation != self.generation(user.username):
+                del self.entries[digest]
+                return None
+            self.entries.move_to_end(digest)
+            return user
+
+    def put(self, digest, user, generation):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[digest] = (user, generation, time.monotonic() + self.ttl)
+            self.entries.move_to_end(digest)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate_user(self, username):
+        """
+        Drops the user's entries in every worker. Call it once the change is committed, so that no worker
+        can cache the previous row under the new generation.
+        """
+        self.generations.bump(username)
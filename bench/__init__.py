@@ -0,0 +1,3 @@
+"""
+Benchmarks for the Y App API. Run a module with `python -m bench.<name>` from the repository root.
+"""
@@ -0,0 +1,91 @@
+"""
+Index advisor: runs every bench.driver operation a few times against a database seeded by bench.dataset,
+EXPLAINs each distinct statement shape the requests issued and reports full table scans, filesorts and
+temporary tables, by operation. Run it before deploying new queries:
+
+    python -m bench.dataset --db sqlite:///advisor.db --scale 0.01
+    python -m bench.advisor --db sqlite:///advisor.db
+
+Against MySQL the plans are the ones production gets; SQLite only approximates them. Exits with 1 when any
+plan has a problem that isn't in ACCEPTED. The write operations change the database, as in bench.driver.
+"""
+import argparse
+from collections import defaultdict
+import os
+import random
+import sys
+
+# (problem, statement shape) pairs that are expected.
+ACCEPTED = {
+    # The profanity filter loads the whole word list, then caches it.
+    ('full scan of bad_words', 'SELECT count(bad_words.id) AS count_1, max(bad_words.id) AS max_1 FROM bad_words'),
+    ('full scan of bad_words', 'SELECT bad_words.word FROM bad_words')
+}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:///bench.db?timeout=30', help='database URL seeded by bench.dataset')
+    parser.add_argument('--repeat', type=int, default=3, help='requests per operation')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--verbose', action='store_true', help='print every statement shape with its plan')
+    args = parser.parse_args()
+
+    os.environ['DB_URL'] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+    from sqlalchemy import event, func, select
+    from bench.driver import Worker
+    from query_profiler import explain_rows, is_explainable, normalize, plan_problems
+
+    # shape -> (statement, parameters) of its first execution
+    executed = {}
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and is_explainable(statement):
+            executed.setdefault(normalize(statement), (statement, parameters))
+    event.listen(app.sql, 'before_cursor_execute', capture)
+
+    with app.sql.connect() as connection:
+        user_count = connection.scalar(select(func.max(app.User.id))) or 0
+        post_count = connection.scalar(select(func.max(app.Post.id))) or 0
+        media_count = connection.scalar(select(func.max(app.Media.id))) or 0
+        contents = connection.scalars(select(app.Post.content).order_by(app.Post.id).limit(200)).all()
+    words = sorted({word for content in contents for word in content.split()})
+    if not user_count or not post_count or len(words) < 2:
+        parser.error(f'{args.db} has no benchmark dataset; seed it with python -m bench.dataset')
+
+    worker = Worker(app.app.test_client(), random.Random(args.seed), list(range(1, user_count + 1)), post_count, media_count, words)
+    operations = sorted(name[len('op_'):] for name in dir(Worker) if name.startswith('op_'))
+    # shape -> [(statement, parameters) of its first execution, operations that ran it...]
+    shapes = defaultdict(list)
+    for operation in operations:
+        executed.clear()
+        for _ in range(args.repeat):
+            getattr(worker, f'op_{operation}')().close()
+        for shape, first in executed.items():
+            if shape not in shapes:
+                shapes[shape].append(first)
+            shapes[shape].append(operation)
+    if app.downvote_queue is not None:
+        app.downvote_queue.stop()
+
+    found = 0
+    with app.sql.connect() as connection:
+        dbapi_connection = connection.connection.dbapi_connection
+        for shape, ((statement, parameters), *shape_operations) in shapes.items():
+            try:
+                columns, rows = explain_rows(dbapi_connection, app.sql.dialect.name, statement, parameters)
+            except Exception as error:
+                print(f'{", ".join(shape_operations)}: EXPLAIN failed for {shape}: {error}')
+                continue
+            problems = [problem for problem in plan_problems(app.sql.dialect.name, columns, rows) if (problem, shape) not in ACCEPTED]
+            found += len(problems)
+            if problems or args.verbose:
+                print(f'{", ".join(shape_operations)}: {"; ".join(problems) or "ok"}')
+                print(f'  {shape}')
+                for row in rows:
+                    print('    ' + '\t'.join(str(value) for value in row))
+    print(f'{len(shapes)} statement shapes from {len(operations)} operations, {found} problems')
+    sys.exit(1 if found else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+"""
+Deterministic benchmark dataset: users, posts, downvotes, media and a bad words list, seeded into a local
+database (SQLite by default) through the app's models. The same seed and scale always give the same rows.
+
+    python -m bench.dataset --db sqlite:///bench.db --scale 0.01
+
+At --scale 1 that is 100k users, 1M posts and 10M downvotes. User N is username userN with API key
+bench-key-N, which is what bench.driver signs in with.
+"""
+import argparse
+import base64
+from datetime import datetime, timedelta
+import hashlib
+import math
+import os
+import random
+import string
+import sys
+import time
+
+BATCH = 10000
+EPOCH = datetime(2024, 1, 1)
+
+def api_key(user_id):
+    return f'bench-key-{user_id}'
+
+def random_word(rng, low=3, high=10):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(low, high)))
+
+def media_size(rng):
+    """
+    Image sizes are roughly log-normal: most are tens of KB, a few reach a couple of MB.
+    """
+    return int(min(max(rng.lognormvariate(math.log(40 * 1024), 1.0), 1024), 2 * 1024 * 1024))
+
+def insert(connection, table, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == BATCH:
+            connection.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        connection.execute(table.insert(), batch)
+
+def generate(app, engine, users, posts, downvotes, media, bad_words, seed, log=print):
+    rng = random.Random(seed)
+    app.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        started = time.perf_counter()
+        vocabulary = [random_word(rng) for _ in range(5000)]
+        bad_word_list = [random_word(rng, 4, 12) for _ in range(bad_words)]
+        insert(connection, app.Bad_Words.__table__, ({'id': index + 1, 'word': word} for index, word in enumerate(bad_word_list)))
+        log(f'{bad_words} bad words')
+
+        media_rows = []
+        for media_id in range(1, media + 1):
+            content = b'\xff\xd8\xff\xe0' + rng.randbytes(media_size(rng))
+            media_rows.append({
+                'id': media_id,
+                'base64': 'data:image/jpeg;base64,' + base64.b64encode(content).decode(),
+                'sha256': hashlib.sha256(content).hexdigest(),
+                'mime_type': 'image/jpeg',
+                'size': len(content),
+                'author_id': None,
+                'created_at': EPOCH
+            })
+            if len(media_rows) == 100:
+                connection.execute(app.Media.__table__.insert(), media_rows)
+                media_rows = []
+        if media_rows:
+            connection.execute(app.Media.__table__.insert(), media_rows)
+        log(f'{media} media')
+
+        insert(connection, app.User.__table__, ({
+            'id': user_id,
+            'media_id': rng.randint(1, media) if media and rng.random() < 0.6 else None,
+            'first_name': rng.choice(vocabulary).capitalize(),
+            'last_name': rng.choice(vocabulary).capitalize(),
+            'username': f'user{user_id}',
+            'dark_mode': rng.random() < 0.5,
+            'profanity_filter': rng.random() < 0.2,
+            'ui_scale': 'Normal',
+            'email': f'user{user_id}@bench.invalid',
+            'password': 'bench',
+            'api_key': api_key(user_id),
+            'api_key_digest': app.hash_api_key(api_key(user_id))
+        } for user_id in range(1, users + 1)))
+        log(f'{users} users')
+
+        # Downvotes go to posts with a heavy tail: a few posts collect most of them.
+        weights = [rng.paretovariate(1.2) for _ in range(posts)]
+        scale = downvotes / sum(weights)
+        counts = [min(int(weight * scale), users) for weight in weights]
+        for index in rng.sample(range(posts), min(posts, downvotes - sum(counts))) if downvotes > sum(counts) else ():
+            counts[index] = min(counts[index] + 1, users)
+        span = timedelta(days=365).total_seconds()
+
+        def post_rows():
+            for post_id in range(1, posts + 1):
+                created_at = EPOCH + timedelta(seconds=span * post_id / posts)
+                yield {
+                    'id': post_id,
+                    'content': ' '.join(rng.choice(bad_word_list) if bad_word_list and rng.random() < 0.01 else rng.choice(vocabulary) for _ in range(rng.randint(3, 60)))[:1024],
+                    'author_id': rng.randint(1, users),
+                    'Media_id': rng.randint(1, media) if media and rng.random() < 0.1 else None,
+                    'created_at': created_at,
+                    'updated_at': created_at,
+                    'downvote_count': counts[post_id - 1],
+                    'penalized_created_at': created_at - timedelta(days=counts[post_id - 1])
+                }
+        insert(connection, app.Post.__table__, post_rows())
+        log(f'{posts} posts')
+
+        def downvote_rows():
+            for post_id, count in enumerate(counts, 1):
+                for user_id in rng.sample(range(1, users + 1), count):
+                    yield {'post_id': post_id, 'user_id': user_id, 'created_at': EPOCH}
+        insert(connection, app.Downvote.__table__, downvote_rows())
+        log(f'{sum(counts)} downvotes')
+        log(f'Seeded in {time.perf_counter() - started:.1f} s')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:///bench.db', help='database URL; the app is pointed at it through DB_URL')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiplies every row count')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--posts', type=int, default=1000000)
+    parser.add_argument('--downvotes', type=int, default=10000000)
+    parser.add_argument('--media', type=int, default=5000)
+    parser.add_argument('--bad-words', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    os.environ['DB_URL'] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+
+    generate(
+        app, app.sql,
+        users=max(int(args.users * args.scale), 1),
+        posts=max(int(args.posts * args.scale), 1),
+        downvotes=int(args.downvotes * args.scale),
+        media=int(args.media * args.scale),
+        bad_words=args.bad_words,
+        seed=args.seed
+    )
+
+if __name__ == '__main__':
+    main()
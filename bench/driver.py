@@ -0,0 +1,267 @@
+"""
+Runs a mixed read/write workload against the app in-process, through the Flask test client, on a database
+seeded by bench.dataset, and saves per-endpoint latency percentiles, throughput and queries per request as JSON.
+
+    python -m bench.driver --db sqlite:///bench.db?timeout=30 --workload mixed --requests 5000 --out run.json
+    python -m bench.report run.json baseline.json
+
+App settings such as FEED_CACHE_SIZE are read from the environment (or --env NAME=VALUE) and recorded in the report.
+Each thread draws its operations from its own seeded generator, so a run is repeatable for a given seed and
+thread count. Write workloads change the database: reseed it, or copy a pristine file, before runs you compare.
+"""
+import argparse
+import base64
+from collections import defaultdict
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+
+# Operation weights per workload.
+WORKLOADS = {
+    'read': {'feed': 40, 'feed_next': 15, 'feed_dislikes': 5, 'search': 10, 'user': 10, 'users_batch': 5, 'media': 10, 'login': 5},
+    'mixed': {'feed': 30, 'feed_next': 10, 'feed_dislikes': 5, 'search': 5, 'user': 5, 'users_batch': 5, 'media': 5, 'login': 5, 'create_post': 10, 'downvote': 15, 'downvote_batch': 3, 'create_media': 2},
+    'write': {'feed': 10, 'create_post': 30, 'downvote': 40, 'downvote_batch': 10, 'create_media': 10}
+}
+
+# App settings recorded with each run, so reports say what they measured.
+SETTING_PREFIXES = ('DB_', 'AUTH_', 'FEED_', 'DOWNVOTE_', 'MEDIA_', 'SEARCH_', 'BAD_WORDS_', 'USER_STREAM_')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+class Counters(threading.local):
+    statements = 0
+
+class Worker:
+    """
+    One simulated client. Users are split between workers by id, so API keys rotated by login stay consistent.
+    """
+    def __init__(self, client, rng, user_ids, post_count, media_count, words):
+        self.client = client
+        self.rng = rng
+        self.user_ids = user_ids
+        self.keys = {}
+        self.post_count = post_count
+        self.media_count = media_count
+        self.words = words
+        self.cursors = {}
+
+    def credentials(self):
+        user_id = self.rng.choice(self.user_ids)
+        return user_id, {'username': f'user{user_id}', 'api_key': self.keys.get(user_id, f'bench-key-{user_id}')}
+
+    def feed(self, **params):
+        user_id, credentials = self.credentials()
+        params = {**credentials, 'limit': 10, 'media': 'url', **params}
+        return user_id, self.client.get('/api/post', query_string=params)
+
+    def op_feed(self):
+        user_id, response = self.feed()
+        self.cursors[user_id] = response.headers.get('X-Next-Cursor')
+        return response
+
+    def op_feed_next(self):
+        """
+        The page after the user's previous feed page, or the first page when there is none.
+        """
+        user_id, credentials = self.credentials()
+        params = {**credentials, 'limit': 10, 'media': 'url'}
+        if self.cursors.get(user_id):
+            params['cursor'] = self.cursors[user_id]
+        response = self.client.get('/api/post', query_string=params)
+        self.cursors[user_id] = response.headers.get('X-Next-Cursor')
+        return response
+
+    def op_feed_dislikes(self):
+        return self.feed(dislikes_only='1')[1]
+
+    def op_search(self):
+        return self.feed(search=' '.join(self.rng.sample(self.words, 2)))[1]
+
+    def op_user(self):
+        return self.client.get(f'/api/user/{self.rng.randint(1, max(self.user_ids))}', query_string={'media': 'url'})
+
+    def op_users_batch(self):
+        ids = ','.join(str(self.rng.randint(1, max(self.user_ids))) for _ in range(20))
+        return self.client.get('/api/users', query_string={'ids': ids, 'media': 'url'})
+
+    def op_media(self):
+        return self.client.get(f'/api/media/{self.rng.randint(1, max(self.media_count, 1))}')
+
+    def op_login(self):
+        user_id = self.rng.choice(self.user_ids)
+        response = self.client.post('/api/login', json={'username': f'user{user_id}', 'password': 'bench'}, query_string={'media': 'url'})
+        if response.status_code == 200:
+            self.keys[user_id] = response.get_json()['api_key']
+        return response
+
+    def op_create_post(self):
+        _, credentials = self.credentials()
+        content = ' '.join(self.rng.choice(self.words) for _ in range(self.rng.randint(3, 60)))[:1024]
+        return self.client.put('/api/post', json={**credentials, 'content': content})
+
+    def op_downvote(self):
+        _, credentials = self.credentials()
+        post_id = self.rng.randint(1, self.post_count)
+        if self.rng.random() < 0.7:
+            return self.client.put(f'/api/post/downvote/{post_id}', json=credentials)
+        return self.client.delete(f'/api/post/downvote/{post_id}', json=credentials)
+
+    def op_downvote_batch(self):
+        _, credentials = self.credentials()
+        downvotes = [{'post_id': self.rng.randint(1, self.post_count), 'action': 'PUT' if self.rng.random() < 0.7 else 'DELETE'} for _ in range(50)]
+        return self.client.post('/api/post/downvotes', json={**credentials, 'downvotes': downvotes})
+
+    def op_create_media(self):
+        _, credentials = self.credentials()
+        # Starts like a JPEG, which is what uploads are checked for.
+        content = b'\xff\xd8\xff\xe0' + self.rng.randbytes(self.rng.randint(1024, 64 * 1024))
+        return self.client.put('/api/media', json={**credentials, 'base64': 'data:image/jpeg;base64,' + base64.b64encode(content).decode()})
+
+def run_worker(worker, weights, count, counters, samples, warmup):
+    names, weights = list(weights), list(weights.values())
+    for index in range(warmup + count):
+        name = worker.rng.choices(names, weights)[0]
+        counters.statements = 0
+        started = time.perf_counter()
+        response = getattr(worker, f'op_{name}')()
+        size = len(response.get_data())
+        response.close()
+        elapsed = time.perf_counter() - started
+        if index >= warmup:
+            samples[name].append((elapsed, counters.statements, response.status_code, size))
+
+def summarize(samples, duration):
+    endpoints = {}
+    for name, entries in sorted(samples.items()):
+        latencies = [entry[0] * 1000 for entry in entries]
+        statements = [entry[1] for entry in entries]
+        statuses = defaultdict(int)
+        for entry in entries:
+            statuses[str(entry[2])] += 1
+        endpoints[name] = {
+            'count': len(entries),
+            'errors': sum(1 for entry in entries if entry[2] >= 500),
+            'statuses': dict(statuses),
+            'throughput_rps': len(entries) / duration,
+            'mean_ms': sum(latencies) / len(latencies),
+            'p50_ms': percentile(latencies, 0.50),
+            'p95_ms': percentile(latencies, 0.95),
+            'p99_ms': percentile(latencies, 0.99),
+            'max_ms': max(latencies),
+            'queries_mean': sum(statements) / len(statements),
+            'queries_max': max(statements),
+            'bytes_mean': sum(entry[3] for entry in entries) / len(entries)
+        }
+    entries = [entry for name in samples for entry in samples[name]]
+    latencies = [entry[0] * 1000 for entry in entries]
+    total = {
+        'count': len(entries),
+        'errors': sum(1 for entry in entries if entry[2] >= 500),
+        'throughput_rps': len(entries) / duration,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'queries_mean': sum(entry[1] for entry in entries) / len(entries) if entries else None
+    }
+    return total, endpoints
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db', default='sqlite:///bench.db?timeout=30', help='database URL seeded by bench.dataset')
+    parser.add_argument('--workload', choices=sorted(WORKLOADS), default='mixed')
+    parser.add_argument('--requests', type=int, default=2000, help='measured requests per thread')
+    parser.add_argument('--warmup', type=int, default=100, help='unmeasured requests per thread, run first')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE', help='app setting, e.g. FEED_CACHE_SIZE=1000')
+    parser.add_argument('--out', help='where to save the JSON report; printed when omitted')
+    args = parser.parse_args()
+
+    os.environ['DB_URL'] = args.db
+    for setting in args.env:
+        name, _, value = setting.partition('=')
+        os.environ[name] = value
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import app
+    from sqlalchemy import event, func, select
+    from sqlalchemy.engine import Engine
+
+    counters = Counters()
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        counters.statements += 1
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+
+    with app.sql.connect() as connection:
+        user_count = connection.scalar(select(func.max(app.User.id))) or 0
+        post_count = connection.scalar(select(func.max(app.Post.id))) or 0
+        media_count = connection.scalar(select(func.max(app.Media.id))) or 0
+        contents = connection.scalars(select(app.Post.content).order_by(app.Post.id).limit(200)).all()
+    words = sorted({word for content in contents for word in content.split()})
+    if user_count < args.threads or not post_count or len(words) < 2:
+        parser.error(f'{args.db} has no benchmark dataset; seed it with python -m bench.dataset')
+
+    samples = defaultdict(list)
+    threads = []
+    for index in range(args.threads):
+        worker = Worker(
+            app.app.test_client(),
+            random.Random(f'{args.seed}-{index}'),
+            list(range(index + 1, user_count + 1, args.threads)),
+            post_count, media_count, words
+        )
+        thread_samples = defaultdict(list)
+        threads.append((threading.Thread(target=run_worker, args=(worker, WORKLOADS[args.workload], args.requests, counters, thread_samples, args.warmup)), thread_samples))
+
+    started = time.perf_counter()
+    for thread, _ in threads:
+        thread.start()
+    for thread, thread_samples in threads:
+        thread.join()
+        for name, entries in thread_samples.items():
+            samples[name].extend(entries)
+    duration = time.perf_counter() - started
+    if app.downvote_queue is not None:
+        app.downvote_queue.stop()
+
+    total, endpoints = summarize(samples, duration)
+    report = {
+        'meta': {
+            'workload': args.workload,
+            'requests_per_thread': args.requests,
+            'warmup_per_thread': args.warmup,
+            'threads': args.threads,
+            'seed': args.seed,
+            'dataset': {'users': user_count, 'posts': post_count, 'media': media_count},
+            'database': app.sql.url.render_as_string(hide_password=True),
+            'settings': {name: value for name, value in sorted(os.environ.items()) if name.startswith(SETTING_PREFIXES) and name != 'DB_URL' and 'PASSWORD' not in name},
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - duration)),
+            'duration_s': duration
+        },
+        'total': total,
+        'endpoints': endpoints
+    }
+    if args.out:
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+if __name__ == '__main__':
+    main()
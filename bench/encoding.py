@@ -0,0 +1,103 @@
+"""
+Micro-benchmark of encoding get_posts pages: CPU time per response and bytes on the wire for Flask's
+default JSON provider, the standard library with precompiled row encoders and orjson (when installed),
+each uncompressed, gzipped at a few levels and brotli-compressed (when installed).
+
+    python -m bench.encoding [--page 20] [--media-ratio 0.3] [--media-scale 1.0]
+
+Media is random bytes, base64 encoded like stored images, so it hardly compresses, as in production.
+"""
+import argparse
+from datetime import timedelta
+import random
+import time
+
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+
+from bench.dataset import EPOCH, media_size, random_word
+from encoding import Compressor, FastJSONProvider, brotli, orjson
+from media_store import encode_media
+
+FEED_FIELDS = [
+    'post_id', 'content', 'first_name', 'last_name', 'username', 'profile_picture_id', 'media_id', 'downvotes',
+    'is_downvoted', 'created_at', 'updated_at', 'profile_picture', 'media'
+]
+
+def make_page(rng, size, media_ratio, media_scale):
+    page = []
+    for index in range(size):
+        created_at = EPOCH + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+        has_picture, has_media = rng.random() < media_ratio, rng.random() < media_ratio
+        page.append({
+            'post_id': index + 1,
+            'content': ' '.join(random_word(rng) for _ in range(rng.randint(5, 60))),
+            'first_name': random_word(rng).capitalize(),
+            'last_name': random_word(rng).capitalize(),
+            'username': f'user{rng.randrange(100000)}',
+            'profile_picture_id': rng.randrange(5000) if has_picture else None,
+            'media_id': rng.randrange(5000) if has_media else None,
+            'downvotes': int(rng.paretovariate(1.5)) - 1,
+            'is_downvoted': rng.random() < 0.1,
+            'created_at': created_at,
+            'updated_at': created_at + timedelta(seconds=rng.randrange(3600)),
+            'profile_picture': encode_media('image/png', rng.randbytes(int(media_size(rng) * media_scale))) if has_picture else None,
+            'media': encode_media('image/jpeg', rng.randbytes(int(media_size(rng) * media_scale))) if has_media else None
+        })
+    return page
+
+def encoders(app):
+    default = DefaultJSONProvider(app)
+    encoders = [('flask default', lambda page: default.dumps(page, separators=(',', ':')).encode())]
+    rows = FastJSONProvider(app, backend='json')
+    rows.register_rows(FEED_FIELDS, ['created_at', 'updated_at'])
+    encoders.append(('json + row encoders', rows.encode))
+    if orjson is not None:
+        encoders.append(('orjson', FastJSONProvider(app, backend='orjson').encode))
+    return encoders
+
+def compressions(levels, brotli_qualities):
+    compressions = [('none', None)] + [(f'gzip {level}', ('gzip', level, 0)) for level in levels]
+    if brotli is not None:
+        compressions += [(f'br {quality}', ('br', 0, quality)) for quality in brotli_qualities]
+    return compressions
+
+def cpu_time(function, repeat):
+    started = time.process_time()
+    for _ in range(repeat):
+        function()
+    return (time.process_time() - started) / repeat
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--page', type=int, default=20, help='posts per feed page')
+    parser.add_argument('--media-ratio', type=float, default=0.3, help='share of posts with media, and of authors with a profile picture')
+    parser.add_argument('--media-scale', type=float, default=1.0, help='multiplies the media sizes of bench.dataset')
+    parser.add_argument('--gzip-levels', default='1,6,9')
+    parser.add_argument('--brotli-qualities', default='1,4,11')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    page = make_page(random.Random(args.seed), args.page, args.media_ratio, args.media_scale)
+    app = Flask(__name__)
+    levels = [int(level) for level in args.gzip_levels.split(',') if level]
+    qualities = [int(quality) for quality in args.brotli_qualities.split(',') if quality]
+
+    print(f'{args.page} posts per page, {args.media_ratio:.0%} with media')
+    print(f'{"encoder":22} {"compression":12} {"CPU us":>10} {"bytes":>12}')
+    for name, encode in encoders(app):
+        body = encode(page)
+        encoding_time = cpu_time(lambda: encode(page), args.repeat)
+        for compression, options in compressions(levels, qualities):
+            if options is None:
+                size, compression_time = len(body), 0
+            else:
+                def compress():
+                    compressor = Compressor(*options)
+                    return compressor.compress(body) + compressor.finish()
+                size, compression_time = len(compress()), cpu_time(compress, max(args.repeat // 5, 1))
+            print(f'{name:22} {compression:12} {(encoding_time + compression_time) * 1e6:10.0f} {size:12}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,57 @@
+"""
+Micro-benchmark of the profanity filter against the per-word list scan it replaced.
+
+    python -m bench.profanity [--words 2000] [--post-length 1024] [--page 20]
+"""
+import argparse
+import random
+import string
+import timeit
+
+from profanity import ProfanityFilter
+
+def random_word(rng, low=3, high=10):
+    return ''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(low, high)))
+
+def make_posts(rng, bad_words, count, length, bad_ratio=0.02):
+    posts = []
+    for _ in range(count):
+        words = []
+        while sum(len(word) + 1 for word in words) < length:
+            word = rng.choice(bad_words) if rng.random() < bad_ratio else random_word(rng)
+            if rng.random() < 0.1:
+                word += rng.choice(',.!?')
+            if rng.random() < 0.05:
+                word = word.capitalize()
+            words.append(word)
+        posts.append(' '.join(words)[:length])
+    return posts
+
+def legacy_mask(bad_word_list, posts):
+    return [' '.join(['***' if word.lower() in bad_word_list else word for word in post.split(' ')]) for post in posts]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--words', type=int, default=2000, help='size of the bad words list')
+    parser.add_argument('--post-length', type=int, default=1024, help='characters per post (posts.content is 1024 wide)')
+    parser.add_argument('--page', type=int, default=20, help='posts per feed page')
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bad_words = [random_word(rng, 4, 12) for _ in range(args.words)]
+    posts = make_posts(rng, bad_words, args.page, args.post_length)
+
+    compile_time = timeit.timeit(lambda: ProfanityFilter(bad_words), number=20) / 20
+    profanity_filter = ProfanityFilter(bad_words)
+    legacy = timeit.timeit(lambda: legacy_mask(bad_words, posts), number=args.repeat) / args.repeat
+    compiled = timeit.timeit(lambda: profanity_filter.mask_all(posts), number=args.repeat) / args.repeat
+
+    print(f'{args.words} bad words, {args.page} posts of {args.post_length} characters')
+    print(f'compile once:         {compile_time * 1e3:8.3f} ms')
+    print(f'list scan per page:   {legacy * 1e3:8.3f} ms')
+    print(f'compiled per page:    {compiled * 1e3:8.3f} ms  ({legacy / compiled:.0f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Prints a bench.driver report, or compares it with a baseline report endpoint by endpoint.
+
+    python -m bench.report run.json [baseline.json] [--max-regression 10]
+
+With --max-regression, exits with status 1 when any endpoint's p95 latency grew by more than that percentage.
+"""
+import argparse
+import json
+import sys
+
+COLUMNS = ('count', 'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'queries_mean')
+
+def load(path):
+    with open(path) as file:
+        return json.load(file)
+
+def change(value, baseline):
+    if value is None or not baseline:
+        return ''
+    return f'{(value - baseline) / baseline * 100:+.0f}%'
+
+def rows(report, baseline=None):
+    endpoints = dict(report['endpoints'], total=report['total'])
+    for name, stats in endpoints.items():
+        base = (dict(baseline['endpoints'], total=baseline['total']) if baseline else {}).get(name, {})
+        cells = []
+        for column in COLUMNS:
+            value = stats.get(column)
+            cell = '' if value is None else f'{value:.1f}' if isinstance(value, float) else str(value)
+            if baseline:
+                cell += f' ({change(value, base.get(column))})' if base.get(column) else ' (new)'
+            cells.append(cell)
+        yield name, cells
+
+def regressions(report, baseline, threshold):
+    for name, stats in report['endpoints'].items():
+        base = baseline['endpoints'].get(name)
+        if base and base['p95_ms'] and stats['p95_ms'] > base['p95_ms'] * (1 + threshold / 100):
+            yield name, base['p95_ms'], stats['p95_ms']
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('report')
+    parser.add_argument('baseline', nargs='?')
+    parser.add_argument('--max-regression', type=float, help='allowed p95 latency growth per endpoint, in percent')
+    args = parser.parse_args()
+
+    report = load(args.report)
+    baseline = load(args.baseline) if args.baseline else None
+    meta = report['meta']
+    print(f"{meta['workload']} workload, {meta['threads']} thread(s), revision {meta['revision']}, {meta['dataset']}")
+    if baseline:
+        print(f"compared with revision {baseline['meta']['revision']}, {baseline['meta']['dataset']}")
+        if baseline['meta']['settings'] != meta['settings']:
+            print(f"settings differ: {baseline['meta']['settings']} -> {meta['settings']}")
+    table = list(rows(report, baseline))
+    widths = [max(len(name) for name, _ in table + [('endpoint', None)])]
+    widths += [max(len(column), *(len(cells[index]) for _, cells in table)) for index, column in enumerate(COLUMNS)]
+    print('  '.join(text.ljust(width) for text, width in zip(('endpoint',) + COLUMNS, widths)))
+    for name, cells in table:
+        print('  '.join(text.ljust(width) for text, width in zip([name] + cells, widths)))
+
+    if baseline and args.max_regression is not None:
+        failed = list(regressions(report, baseline, args.max_regression))
+        for name, before, after in failed:
+            print(f'{name}: p95 {before:.1f} ms -> {after:.1f} ms', file=sys.stderr)
+        if failed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
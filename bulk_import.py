@@ -0,0 +1,69 @@
+"""
+Input side of `flask import`: rows streamed from NDJSON or CSV files, in batches, so imports of any size
+run in bounded memory.
+"""
+import csv
+import json
+import time
+
+FORMATS = ('ndjson', 'csv')
+
+def input_format(filename, default='ndjson'):
+    if filename.endswith('.csv'):
+        return 'csv'
+    if filename.endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return default
+
+def read_rows(file, format):
+    """
+    Yields each row of file as a dict. CSV files have a header line; empty CSV fields are left out.
+    Raises ValueError, with the line number, on a line that isn't a JSON object.
+    """
+    if format == 'csv':
+        for row in csv.DictReader(file):
+            yield {name: value for name, value in row.items() if value not in ('', None)}
+        return
+    for number, line in enumerate(file, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            raise ValueError(f'Line {number}: {error}') from None
+        if not isinstance(row, dict):
+            raise ValueError(f'Line {number}: expected a JSON object')
+        yield row
+
+def batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class ImportProgress:
+    """
+    Counts imported and skipped rows, the latter by reason, and reports them with the import rate.
+    """
+    def __init__(self, kind):
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.imported = 0
+        self.skipped = {}
+
+    def skip(self, reason, count=1):
+        if count:
+            self.skipped[reason] = self.skipped.get(reason, 0) + count
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.started
+        rows = self.imported + sum(self.skipped.values())
+        skipped = ', '.join(f'{count} {reason}' for reason, count in sorted(self.skipped.items()))
+        return (
+            f'Imported {self.imported} {self.kind} of {rows} rows in {elapsed:.1f} s ({rows / elapsed if elapsed else 0:.0f} rows/s)'
+            + (f'; skipped {skipped}' if skipped else '')
+        )
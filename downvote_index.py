@@ -0,0 +1,58 @@
+"""
+Per-user index of downvoted posts: a sorted array of post ids per user, cached per process.
+Membership (is_downvoted) is a binary search and dislikes_only an intersection, instead of per-post queries.
+"""
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+import threading
+import time
+
+from shared_memory import Generations
+
+def contains(post_ids, post_id):
+    position = bisect_left(post_ids, post_id)
+    return position < len(post_ids) and post_ids[position] == post_id
+
+class UserDownvoteIndex:
+    """
+    Entries expire after ttl seconds, and sooner when the user's generation changes: downvote changes bump it
+    once committed, and every worker on the host then reloads that user (see shared_memory.Generations).
+    """
+    def __init__(self, path, max_users=10000, ttl=10, slots=65536):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.generations = Generations(path, slots)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+
+    def get(self, user_id, load):
+        """
+        The user's downvoted post ids, ascending. load(user_id) must return them in that order.
+        """
+        generation = self.generations.get(user_id)
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None and entry[1] == generation and time.monotonic() < entry[2]:
+                self.entries.move_to_end(user_id)
+                return entry[0]
+        post_ids = array('q', load(user_id))
+        # A change committed while loading bumped the generation, and the load may predate it: don't keep it.
+        if self.generations.get(user_id) != generation:
+            return post_ids
+        with self.lock:
+            self.entries[user_id] = (post_ids, generation, time.monotonic() + self.ttl)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_users:
+                self.entries.popitem(last=False)
+        return post_ids
+
+    def changed(self, user_ids):
+        """
+        Drops the users' entries in every worker. Call it once their downvote changes are committed.
+        """
+        for user_id in user_ids:
+            self.generations.bump(user_id)
+        with self.lock:
+            for user_id in user_ids:
+                self.entries.pop(user_id, None)
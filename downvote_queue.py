@@ -0,0 +1,92 @@
+"""
+Write-behind queue for downvote changes. Requests record the user's intent and return; a background
+thread applies the intents in batches. Repeated toggles of the same (post_id, user_id) before a flush
+collapse into the last one, so a PUT followed by a DELETE costs at most a single no-op at flush time.
+"""
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class DownvoteQueue:
+    def __init__(self, flush, max_batch=500, interval=0.5):
+        """
+        flush is called from the worker thread with {(post_id, user_id): downvoted} and must apply it atomically.
+        """
+        self.flush = flush
+        self.max_batch = max_batch
+        self.interval = interval
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.in_flight = {}
+        self.thread = None
+        self.stopped = False
+
+    def enqueue(self, post_id, user_id, downvoted):
+        with self.condition:
+            if self.stopped:
+                raise RuntimeError('The downvote queue is stopped')
+            self.pending[(post_id, user_id)] = downvoted
+            if self.thread is None:
+                # Started on first use rather than at import, so each forked worker gets its own.
+                self.thread = threading.Thread(target=self._run, name='downvote-queue', daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.max_batch:
+                self.condition.notify()
+
+    def discard(self, keys):
+        """
+        Drops pending intents superseded by a change the caller applies directly.
+        """
+        with self.condition:
+            for key in keys:
+                self.pending.pop(key, None)
+
+    def intents_for(self, user_id):
+        """
+        {post_id: downvoted} for the user's changes that may not be in the database yet.
+        """
+        with self.condition:
+            intents = {post_id: downvoted for (post_id, user), downvoted in self.in_flight.items() if user == user_id}
+            intents.update((post_id, downvoted) for (post_id, user), downvoted in self.pending.items() if user == user_id)
+            return intents
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.stopped and len(self.pending) < self.max_batch:
+                    self.condition.wait(self.interval)
+                stopped = self.stopped
+            self._flush_pending()
+            if stopped:
+                return
+
+    def _flush_pending(self):
+        with self.condition:
+            if not self.pending:
+                return
+            self.in_flight, self.pending = self.pending, {}
+        try:
+            self.flush(self.in_flight)
+        except Exception:
+            logger.exception('Flushing %d downvotes failed; they will be retried', len(self.in_flight))
+            with self.condition:
+                # Intents queued meanwhile are newer and win.
+                self.pending = {**self.in_flight, **self.pending}
+                self.in_flight = {}
+            return
+        with self.condition:
+            self.in_flight = {}
+
+    def stop(self, timeout=10):
+        """
+        Flushes what is queued and stops the worker; called at shutdown.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+            thread = self.thread
+        if thread is not None:
+            thread.join(timeout)
+        else:
+            self._flush_pending()
@@ -0,0 +1,216 @@
+"""
+Response encoding: a JSON provider with an optional orjson backend and precompiled encoders for the row
+shapes of hot listings, and gzip/brotli compression negotiated with Accept-Encoding.
+"""
+from datetime import date, datetime, timezone
+from json import dumps as json_dumps
+from json.encoder import encode_basestring_ascii
+import zlib
+
+from flask.json.provider import DefaultJSONProvider, _default
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+def http_date(value):
+    """
+    Formats like werkzeug.http.http_date, which Flask uses for dates, without going through email.utils.
+    """
+    if not isinstance(value, datetime):
+        value = datetime(value.year, value.month, value.day)
+    elif value.tzinfo is not None:
+        value = value.astimezone(timezone.utc)
+    return (
+        f'{WEEKDAYS[value.weekday()]}, {value.day:02d} {MONTHS[value.month - 1]} {value.year:04d} '
+        f'{value.hour:02d}:{value.minute:02d}:{value.second:02d} GMT'
+    )
+
+def iso_date(value):
+    return value.isoformat()
+
+DATE_FORMATS = {'http': http_date, 'iso': iso_date}
+
+class RowEncoder:
+    """
+    Encodes dicts with one fixed set of keys, the same way json.dumps does with sorted keys and ASCII
+    output: the keys are sorted and escaped once, and date fields skip the default() fallback.
+    """
+    def __init__(self, fields, date_fields, format_date, encode_value):
+        self.fields = frozenset(fields)
+        self.format_date = format_date
+        self.encode_value = encode_value
+        self.parts = [
+            (('{' if index == 0 else ',') + encode_basestring_ascii(field) + ':', field, field in date_fields)
+            for index, field in enumerate(sorted(fields))
+        ]
+
+    def encode(self, row):
+        encoded = []
+        for prefix, field, is_date in self.parts:
+            value = row[field]
+            if value is None:
+                encoded.append(prefix + 'null')
+            elif is_date:
+                encoded.append(prefix + encode_basestring_ascii(self.format_date(value)))
+            elif value is True or value is False:
+                encoded.append(prefix + ('true' if value else 'false'))
+            elif type(value) is str:
+                encoded.append(prefix + encode_basestring_ascii(value))
+            elif type(value) is int:
+                encoded.append(prefix + int.__repr__(value))
+            else:
+                encoded.append(prefix + self.encode_value(value))
+        return ''.join(encoded) + '}'
+
+class FastJSONProvider(DefaultJSONProvider):
+    """
+    Flask's JSON provider, encoding with orjson when it is installed (backend 'orjson') and otherwise with
+    the standard library plus the row encoders registered with register_rows. Dates are formatted as HTTP
+    dates like Flask does, or as ISO 8601 with date_format 'iso'.
+    """
+    def __init__(self, app, backend=None, date_format='http'):
+        super().__init__(app)
+        if backend == 'orjson' and orjson is None:
+            raise RuntimeError('The orjson JSON backend needs the orjson package')
+        self.backend = backend or ('orjson' if orjson is not None else 'json')
+        self.format_date = DATE_FORMATS[date_format]
+        self.row_encoders = {}
+        if orjson is not None:
+            self.orjson_options = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS
+            if date_format != 'iso':
+                # orjson writes dates as ISO 8601 itself; other formats go through default().
+                self.orjson_options |= orjson.OPT_PASSTHROUGH_DATETIME
+
+    def default(self, value):
+        if isinstance(value, date):
+            return self.format_date(value)
+        return _default(value)
+
+    def register_rows(self, fields, date_fields=()):
+        """
+        Precompiles the encoding of dicts with exactly these keys, for listings whose rows all share a shape.
+        """
+        self.row_encoders[frozenset(fields)] = RowEncoder(fields, set(date_fields), self.format_date, self._encode_value)
+
+    def _encode_value(self, value):
+        return json_dumps(value, default=self.default, ensure_ascii=True, sort_keys=True, separators=(',', ':'))
+
+    def _encode(self, obj):
+        """
+        The compact JSON encoding of obj, as bytes from orjson or as str from the standard library.
+        """
+        if self.backend == 'orjson':
+            return orjson.dumps(obj, default=self.default, option=self.orjson_options)
+        if type(obj) is dict:
+            encoder = self.row_encoders.get(frozenset(obj))
+            if encoder is not None:
+                return encoder.encode(obj)
+        elif type(obj) is list and obj and type(obj[0]) is dict:
+            encoder = self.row_encoders.get(frozenset(obj[0]))
+            if encoder is not None and all(type(row) is dict and len(row) == len(encoder.fields) and encoder.fields.issuperset(row) for row in obj):
+                return '[' + ','.join(encoder.encode(row) for row in obj) + ']'
+        return self._encode_value(obj)
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            kwargs.setdefault('default', self.default)
+            return super().dumps(obj, **kwargs)
+        encoded = self._encode(obj)
+        return encoded.decode() if type(encoded) is bytes else encoded
+
+    def encode(self, obj):
+        encoded = self._encode(obj)
+        return encoded if type(encoded) is bytes else encoded.encode()
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj) + b'\n', mimetype=self.mimetype)
+
+def is_compressible(mimetype):
+    return mimetype is not None and (mimetype == 'application/json' or mimetype.startswith('text/'))
+
+def choose_encoding(accept_encodings):
+    """
+    The best of br (when brotli is installed) and gzip accepted by the client, or None.
+    """
+    supported = ('br', 'gzip') if brotli is not None else ('gzip',)
+    qualities = [(accept_encodings[encoding], -index, encoding) for index, encoding in enumerate(supported)]
+    quality, _, encoding = max(qualities)
+    return encoding if quality > 0 else None
+
+class Compressor:
+    def __init__(self, encoding, level, brotli_quality):
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=brotli_quality)
+            self.compress = compressor.process
+            self.flush = compressor.flush
+            self.finish = compressor.finish
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self.compress = compressor.compress
+            self.flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.finish = compressor.flush
+
+    def compress_chunk(self, data):
+        return self.compress(data) + self.flush()
+
+    def compress_all(self, data):
+        return self.compress(data) + self.finish()
+
+def call(function, *args):
+    return function(*args)
+
+def compressed_chunks(body, compressor, run=call):
+    """
+    Compresses a streamed body chunk by chunk, flushing each so the client still receives it progressively.
+    """
+    try:
+        for chunk in body:
+            if chunk:
+                yield run(compressor.compress_chunk, chunk.encode() if isinstance(chunk, str) else chunk)
+        yield run(compressor.finish)
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+def compress_response(response, accept_encodings, min_size=1024, level=6, brotli_quality=4, run=call):
+    """
+    Compresses a JSON or text response in place for a client accepting gzip or br. Bodies under min_size
+    are left alone, and so are files sent directly, which are media that is compressed already.
+    The compression is done through run(function, *args), which may hand it to a thread.
+    """
+    if (
+        response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough
+        or 'Content-Encoding' in response.headers or not is_compressible(response.mimetype)
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+    size = response.content_length
+    if size is None and not response.is_streamed:
+        size = len(response.get_data())
+    if size is not None and size < min_size:
+        return response
+    compressor = Compressor(encoding, level, brotli_quality)
+    if response.is_streamed:
+        response.response = compressed_chunks(response.response, compressor, run)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(run(compressor.compress_all, response.get_data()))
+    response.headers['Content-Encoding'] = encoding
+    return response
@@ -0,0 +1,106 @@
+"""
+Per-process cache of the top of the global feed ranking. Every viewer sees the same order, so the
+first pages are served from memory and only per-viewer fields are overlaid at response time.
+
+The cache holds the highest ranked posts, i.e. every post ranked above its last entry. Writes in this
+process update it in place; a reload every ttl seconds picks up writes made by other workers.
+"""
+from bisect import bisect_left, insort
+import copy
+import threading
+import time
+
+class FeedCache:
+    def __init__(self, size=1000, ttl=5):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Ranking keys (penalized_created_at, post_id), ascending; the top of the feed is at the end.
+        self.keys = []
+        self.rows = {}
+        self.complete = False
+        self.loaded_at = None
+        # Bumped by every change, so a load that raced with one is not trusted for longer than a page.
+        self.generation = 0
+
+    def page(self, load, limit, offset=0, after=None):
+        """
+        Returns ([key], [row]) for the page, best ranked first, or None when it reaches past the cache.
+        load(size) must return the top size (key, row) pairs of the ranking, best first.
+        """
+        with self.lock:
+            stale = self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl
+            generation = self.generation
+        if stale:
+            # Loaded outside the lock, so requests waiting on the database don't hold up the others.
+            entries = load(self.size)
+        with self.lock:
+            if stale:
+                self._store(entries, current=generation == self.generation)
+            end = len(self.keys) - offset if after is None else bisect_left(self.keys, after)
+            start = max(end, 0) - limit
+            if start < 0 and not self.complete:
+                return None
+            start, end = max(start, 0), max(end, 0)
+            keys = self.keys[start:end][::-1]
+            return keys, [copy.copy(self.rows[key[1]]) for key in keys]
+
+    def _store(self, entries, current=True):
+        """
+        Replaces the contents with freshly loaded entries. When the cache changed while they were
+        loading, they may miss that change: they serve this page, and the next one reloads.
+        """
+        self.keys = sorted(key for key, _ in entries)
+        self.rows = {key[1]: row for key, row in entries}
+        self.complete = len(entries) < self.size
+        self.loaded_at = time.monotonic() if current else None
+
+    def _covers(self, key):
+        return self.complete or (self.keys and key > self.keys[0])
+
+    def _remove(self, post_id):
+        row = self.rows.pop(post_id, None)
+        if row is not None:
+            self.keys.remove(next(key for key in self.keys if key[1] == post_id))
+            if not self.complete and len(self.keys) < self.size // 2:
+                self.loaded_at = None
+        return row
+
+    def post_added(self, key, row):
+        with self.lock:
+            self.generation += 1
+            if self.loaded_at is not None and self._covers(key):
+                insort(self.keys, key)
+                self.rows[key[1]] = row
+                if len(self.keys) > self.size:
+                    del self.rows[self.keys.pop(0)[1]]
+                    self.complete = False
+
+    def post_removed(self, post_id):
+        with self.lock:
+            self.generation += 1
+            self._remove(post_id)
+
+    def downvotes_changed(self, post_id, penalized_created_at, downvote_count):
+        with self.lock:
+            self.generation += 1
+            if self.loaded_at is None:
+                return
+            key = (penalized_created_at, post_id)
+            row = self._remove(post_id)
+            if row is None:
+                if self._covers(key):
+                    # A post below the cache moved up into it; its row has to come from the database.
+                    self.loaded_at = None
+                return
+            row['downvotes'] = downvote_count
+            if self._covers(key):
+                insort(self.keys, key)
+                self.rows[post_id] = row
+
+    def author_changed(self, username, **fields):
+        with self.lock:
+            self.generation += 1
+            for row in self.rows.values():
+                if row['username'] == username:
+                    row.update(fields)
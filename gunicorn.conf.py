@@ -0,0 +1,45 @@
+"""
+Gunicorn settings, read from the working directory by default.
+
+The app is imported once in the master and forked into the workers (preload_app), so a worker that is
+recycled, e.g. under --max-requests, starts without importing Flask, SQLAlchemy and flasgger or building
+the engine again. The pooled connections a worker inherits are dropped by app.py after the fork.
+GUNICORN_PRELOAD=0 imports the app in every worker instead, which code reloading needs.
+
+Each worker logs how long it took from fork to ready, and records it in worker_startup_seconds.
+
+The workers share their metrics through snapshot files in METRICS_DIR, a new temporary directory unless
+it is set. It is emptied when the server starts, and the file of each worker that exits is folded into
+the retired totals.
+"""
+import os
+import tempfile
+import time
+
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1').strip().lower() in ('1', 'true', 'yes', 'on')
+
+# Set before the app is imported, so that every worker reads it.
+metrics_dir = os.environ.get('METRICS_DIR') or tempfile.mkdtemp(prefix='y-metrics-')
+os.environ['METRICS_DIR'] = metrics_dir
+
+def on_starting(server):
+    os.makedirs(metrics_dir, exist_ok=True)
+    for entry in os.listdir(metrics_dir):
+        if entry.endswith('.json'):
+            os.remove(os.path.join(metrics_dir, entry))
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+def post_worker_init(worker):
+    import app
+
+    elapsed = time.perf_counter() - worker.forked_at
+    worker.log.info('Worker %s ready %.3f s after fork', worker.pid, elapsed)
+    if app.METRICS_ENABLED:
+        app.metrics.observe('worker_startup_seconds', elapsed)
+
+def child_exit(server, worker):
+    from metrics import retire_snapshot
+
+    retire_snapshot(metrics_dir, worker.pid)
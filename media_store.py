@@ -0,0 +1,119 @@
+"""
+Content-addressed storage for media bytes, outside the database.
+Blobs are named by the SHA-256 of their decoded bytes, so a blob never changes once written.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import re
+import tempfile
+
+DATA_URI = re.compile(r'^data:(?P<mime_type>[\w.+-]+/[\w.+-]+)?(?:;[^,;]*)*;base64,', re.IGNORECASE)
+# The raster formats accepted for upload and served inline, by their first bytes. SVG is left out: it can carry scripts.
+IMAGE_SIGNATURES = (
+    ('image/png', b'\x89PNG\r\n\x1a\n'),
+    ('image/jpeg', b'\xff\xd8\xff'),
+    ('image/gif', b'GIF87a'),
+    ('image/gif', b'GIF89a')
+)
+# Enough leading bytes for image_type.
+SIGNATURE_SIZE = 12
+
+class MediaStoreMissing(Exception):
+    """
+    Media whose bytes were moved to the blob store was requested while MEDIA_STORE_PATH is unset.
+    """
+
+def decode_media(value):
+    """
+    Splits a base64 upload, optionally a data URI, into (mime_type, bytes). Raises ValueError if it is not base64.
+    Whitespace is ignored, so line-wrapped base64 (base64.encodebytes) is accepted.
+    """
+    if not isinstance(value, str):
+        raise ValueError('Media must be a base64 string')
+    mime_type = None
+    prefix = DATA_URI.match(value)
+    if prefix is not None:
+        mime_type = prefix.group('mime_type') or 'application/octet-stream'
+        value = value[prefix.end():]
+    try:
+        return mime_type, base64.b64decode(''.join(value.split()), validate=True)
+    except binascii.Error as error:
+        raise ValueError('Media must be a base64 string') from error
+
+def image_type(data):
+    """
+    The mime type of a PNG, JPEG, GIF or WebP image from its first bytes, or None.
+    """
+    for mime_type, signature in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime_type
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+def check_image(mime_type, data):
+    """
+    Raises ValueError unless data is a PNG, JPEG, GIF or WebP image, of the declared mime type if there is one.
+    Since the bytes decide the type, media deduplicated on them can't be served with another upload's type.
+    """
+    detected = image_type(data)
+    if detected is None:
+        raise ValueError('Media must be a PNG, JPEG, GIF or WebP image')
+    if mime_type is not None and mime_type.lower() != detected:
+        raise ValueError(f'Media is {detected}, not {mime_type}')
+
+def encode_media(mime_type, data):
+    """
+    Inverse of decode_media: the base64 string clients uploaded, with its data URI prefix if it had one.
+    """
+    encoded = base64.b64encode(data).decode()
+    return f'data:{mime_type};base64,{encoded}' if mime_type else encoded
+
+def digest_media(data):
+    return hashlib.sha256(data).hexdigest()
+
+class FileSystemBlobStore:
+    """
+    Blobs under root/ab/cd/abcd..., sharded on the first two bytes of the digest.
+    """
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def path(self, digest):
+        """
+        The blob's file, which get_media sends with sendfile.
+        """
+        if not re.fullmatch(r'[0-9a-f]{64}', digest or ''):
+            raise ValueError('Invalid digest')
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        digest = digest_media(data)
+        path = self.path(digest)
+        if os.path.exists(path):
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename, so readers never see a partial blob and concurrent uploads of it are harmless.
+        descriptor, temporary = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.upload-')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(data)
+            os.replace(temporary, path)
+        except BaseException:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        return digest
+
+    def get(self, digest):
+        with open(self.path(digest), 'rb') as file:
+            return file.read()
+
+def blob_store_from_env():
+    """
+    The store configured by MEDIA_STORE_PATH, or None to keep media in the media.base64 column.
+    """
+    root = os.environ.get('MEDIA_STORE_PATH')
+    return FileSystemBlobStore(root) if root else None
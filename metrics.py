@@ -0,0 +1,212 @@
+"""
+Process-local histograms and gauges, rendered in the Prometheus text format.
+
+Under gunicorn every worker keeps its own metrics. When a directory is configured, as gunicorn.conf.py
+does, each worker writes a snapshot to <directory>/<pid>.json (at most once per flush interval, and at
+exit) and a scrape served by any worker merges all of them: histograms are summed over every file, while
+gauges only count workers that are still alive. The snapshots of workers that exited are folded into
+retired.json by retire_snapshot, so their totals survive worker restarts without their files piling up.
+"""
+import json
+import os
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100, 250)
+ROW_BUCKETS = (0, 1, 10, 100, 1000, 10000, 100000)
+BYTE_BUCKETS = (256, 1024, 10 * 1024, 100 * 1024, 1024 * 1024, 10 * 1024 * 1024)
+RETIRED = 'retired.json'
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def read_snapshot(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        # Missing, or a partial file left by a crash.
+        return None
+
+def write_snapshot(path, snapshot):
+    temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(temporary, 'w') as file:
+        json.dump(snapshot, file)
+    os.replace(temporary, path)
+
+def merge_histograms(merged, histograms):
+    """
+    Adds snapshot histograms, [[name, labels, counts]], to {(name, labels): counts}.
+    """
+    for name, labels, counts in histograms:
+        totals = merged.setdefault((name, tuple(tuple(label) for label in labels)), [0] * len(counts))
+        for index, count in enumerate(counts):
+            totals[index] += count
+    return merged
+
+def retire_snapshot(directory, pid):
+    """
+    Folds the histograms of a worker that exited into retired.json and deletes its snapshot. Its pid is
+    listed as retired meanwhile, so scrapes don't count it twice. Called by the gunicorn master only.
+    """
+    path = os.path.join(directory, f'{pid}.json')
+    snapshot = read_snapshot(path)
+    if snapshot is None:
+        return
+    retired_path = os.path.join(directory, RETIRED)
+    retired = read_snapshot(retired_path) or {'pid': 0, 'histograms': [], 'gauges': []}
+    merged = merge_histograms(merge_histograms({}, retired['histograms']), snapshot['histograms'])
+    retired['histograms'] = [[name, [list(label) for label in labels], counts] for (name, labels), counts in merged.items()]
+    write_snapshot(retired_path, {**retired, 'retired': [pid]})
+    os.remove(path)
+    write_snapshot(retired_path, {**retired, 'retired': []})
+
+class RequestStats:
+    """
+    What one request spent, accumulated by the database and JSON hooks while it runs.
+    """
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.db_time = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.serialization = 0.0
+        self.responded = False
+
+def counting_bytes(body, on_chunk):
+    """
+    Passes a streamed response body through, reporting the size of each chunk; closing it closes the body.
+    """
+    try:
+        for chunk in body:
+            on_chunk(len(chunk))
+            yield chunk
+    finally:
+        close = getattr(body, 'close', None)
+        if close is not None:
+            close()
+
+class Metrics:
+    def __init__(self, directory=None, flush_interval=1.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        # name -> (type, help, buckets)
+        self.definitions = {}
+        # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self.histograms = {}
+        # (name, labels) -> value
+        self.gauges = {}
+        self.collectors = []
+        self.flushed_at = 0
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self.definitions[name] = ('histogram', help, tuple(buckets))
+
+    def gauge(self, name, help):
+        self.definitions[name] = ('gauge', help, None)
+
+    def observe(self, name, value, **labels):
+        buckets = self.definitions[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            counts = self.histograms.get(key)
+            if counts is None:
+                counts = self.histograms[key] = [0] * (len(buckets) + 2)
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+            counts[-1] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def collector(self, collect):
+        """
+        Registers collect() to be called before every snapshot, to sample gauges.
+        """
+        self.collectors.append(collect)
+        return collect
+
+    def snapshot(self):
+        for collect in self.collectors:
+            collect()
+        with self.lock:
+            return {
+                'pid': os.getpid(),
+                'histograms': [[name, labels, list(counts)] for (name, labels), counts in self.histograms.items()],
+                'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()]
+            }
+
+    def flush(self, force=False):
+        """
+        Writes this process's snapshot to the metrics directory, if there is one and it is due.
+        """
+        if self.directory is None or (not force and time.monotonic() - self.flushed_at < self.flush_interval):
+            return
+        self.flushed_at = time.monotonic()
+        write_snapshot(os.path.join(self.directory, f'{os.getpid()}.json'), self.snapshot())
+
+    def snapshots(self):
+        if self.directory is None:
+            return [self.snapshot()]
+        self.flush(force=True)
+        snapshots = [read_snapshot(os.path.join(self.directory, entry)) for entry in os.listdir(self.directory) if entry.endswith('.json')]
+        snapshots = [snapshot for snapshot in snapshots if snapshot is not None]
+        retired = {pid for snapshot in snapshots for pid in snapshot.get('retired', ())}
+        return [snapshot for snapshot in snapshots if snapshot['pid'] not in retired]
+
+    def render(self):
+        """
+        The metrics of every worker, merged, in the Prometheus text exposition format.
+        """
+        histograms, gauges = {}, {}
+        for snapshot in self.snapshots():
+            merge_histograms(histograms, snapshot['histograms'])
+            if snapshot['pid'] == os.getpid() or pid_alive(snapshot['pid']):
+                for name, labels, value in snapshot['gauges']:
+                    key = (name, tuple(tuple(label) for label in labels))
+                    gauges[key] = gauges.get(key, 0) + value
+
+        lines = []
+        for name, (kind, help, buckets) in sorted(self.definitions.items()):
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'gauge':
+                for (gauge, labels), value in sorted(gauges.items()):
+                    if gauge == name:
+                        lines.append(f'{name}{format_labels(labels)} {format_value(value)}')
+                continue
+            for (histogram, labels), counts in sorted(histograms.items()):
+                if histogram != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, [("le", format_value(bound))])} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {format_value(counts[-1])}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
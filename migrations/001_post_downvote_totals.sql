@@ -0,0 +1,12 @@
+-- Denormalized downvote totals on posts (see Post.downvote_count), filled in from the downvotes table.
+ALTER TABLE posts
+    ADD COLUMN downvote_count INT NOT NULL DEFAULT 0,
+    ADD COLUMN penalized_created_at DATETIME NULL;
+
+-- Every downvote pushes a post one day further back in the feed (see penalize).
+UPDATE posts
+    LEFT JOIN (SELECT post_id, COUNT(*) AS downvotes FROM downvotes GROUP BY post_id) AS totals ON totals.post_id = posts.id
+    SET posts.downvote_count = COALESCE(totals.downvotes, 0),
+        posts.penalized_created_at = DATE_SUB(posts.created_at, INTERVAL COALESCE(totals.downvotes, 0) DAY);
+
+CREATE INDEX ix_posts_penalized_created_at ON posts (penalized_created_at, id);
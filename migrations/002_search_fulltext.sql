@@ -0,0 +1,4 @@
+-- FULLTEXT indexes behind the feed's search parameter (see search_post_ids).
+CREATE FULLTEXT INDEX ix_posts_content_fulltext ON posts (content);
+
+CREATE FULLTEXT INDEX ix_users_names_fulltext ON users (username, first_name, last_name);
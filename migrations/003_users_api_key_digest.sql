@@ -0,0 +1,6 @@
+-- Indexed SHA-256 of users.api_key; requests are authenticated against it (see authenticate).
+ALTER TABLE users ADD COLUMN api_key_digest VARCHAR(64) NULL;
+
+UPDATE users SET api_key_digest = SHA2(api_key, 256) WHERE api_key IS NOT NULL;
+
+CREATE INDEX ix_users_api_key_digest ON users (api_key_digest);
@@ -0,0 +1,5 @@
+-- Media bytes can live in the blob store (MEDIA_STORE_PATH), addressed by their SHA-256.
+ALTER TABLE media
+    ADD COLUMN sha256 CHAR(64) NULL,
+    ADD COLUMN mime_type VARCHAR(128) NULL,
+    ADD COLUMN size INT NULL;
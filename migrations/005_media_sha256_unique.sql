@@ -0,0 +1,2 @@
+-- Run `flask --app app backfill-media-digests --merge-duplicates` first, so existing media have unique digests.
+CREATE UNIQUE INDEX ix_media_sha256 ON media (sha256);
@@ -0,0 +1,2 @@
+-- The downvotes primary key leads with post_id; per-user lookups (is_downvoted, dislikes_only) need this one.
+CREATE INDEX ix_downvotes_user_id_post_id ON downvotes (user_id, post_id);
@@ -0,0 +1,78 @@
+"""
+Profanity masking for users with the profanity filter enabled.
+The bad words list is compiled once per process and reloaded only when the bad_words table changes.
+"""
+import re
+import string
+import threading
+import time
+
+MASK = '***'
+WORD = re.compile(r'\S+')
+PUNCTUATION = string.punctuation + '“”‘’«»…'
+# Joins a page of posts so it is masked in one pass; it is whitespace, so no word spans two posts.
+SEPARATOR = '\x1e'
+
+class ProfanityFilter:
+    def __init__(self, words):
+        self.words = frozenset(word.strip().lower() for word in words if word and word.strip())
+
+    def _mask_word(self, match):
+        word = match.group(0)
+        lowered = word.lower()
+        if lowered in self.words:
+            return MASK
+        core = lowered.strip(PUNCTUATION)
+        if core and core in self.words:
+            start = len(lowered) - len(lowered.lstrip(PUNCTUATION))
+            end = start + len(core)
+            return word[:start] + MASK + word[end:]
+        return word
+
+    def mask(self, text):
+        if not text or not self.words:
+            return text
+        return WORD.sub(self._mask_word, text)
+
+    def mask_all(self, texts):
+        """
+        Masks a list of texts (None allowed) in a single pass over their concatenation.
+        """
+        if not self.words or any(text and SEPARATOR in text for text in texts):
+            return [self.mask(text) for text in texts]
+        present = [text for text in texts if text]
+        masked = iter(self.mask(SEPARATOR.join(present)).split(SEPARATOR)) if present else iter(())
+        return [next(masked) if text else text for text in texts]
+
+class ProfanityFilterCache:
+    """
+    Holds the compiled filter of this process. At most every ttl seconds the table's version is
+    compared with the one the filter was compiled from, and the words are only reloaded when it differs,
+    or when they were loaded max_age seconds ago: a version can miss words edited in place.
+    """
+    def __init__(self, ttl=60, max_age=600):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.filter = None
+        self.version = None
+        self.checked_at = 0
+        self.loaded_at = 0
+
+    def get(self, load_version, load_words):
+        """
+        The loaders run outside the lock, so a request waiting on the database never holds up the others;
+        concurrent reloads just compile the same words twice.
+        """
+        with self.lock:
+            if self.filter is not None and time.monotonic() - self.checked_at < self.ttl:
+                return self.filter
+            current, current_version, loaded_at = self.filter, self.version, self.loaded_at
+        version = load_version()
+        if current is None or version != current_version or time.monotonic() - loaded_at >= self.max_age:
+            current = ProfanityFilter(load_words())
+            loaded_at = time.monotonic()
+        with self.lock:
+            self.filter, self.version, self.loaded_at = current, version, loaded_at
+            self.checked_at = time.monotonic()
+        return current
@@ -0,0 +1,131 @@
+"""
+Development-mode query profiler. Every statement a request runs is reduced to its shape (literals and
+parameters replaced, IN lists collapsed) and attributed to the line of app code that issued it, so
+N+1 patterns show up as one shape repeated many times. Slow statements are reported with their plan.
+"""
+import os
+import re
+import sys
+import traceback
+
+STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+NUMBER = re.compile(r'(?<![\w.])-?\d+(?:\.\d+)?\b')
+PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|\?|(?<!:):\w+')
+IN_LIST = re.compile(r'\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)', re.IGNORECASE)
+VALUES_LIST = re.compile(r'\bVALUES\s*\([^()]*\)(?:\s*,\s*\([^()]*\))*', re.IGNORECASE)
+SPACE = re.compile(r'\s+')
+
+class QueryLimitExceeded(AssertionError):
+    pass
+
+def normalize(statement):
+    shape = STRING.sub('?', statement)
+    shape = PLACEHOLDER.sub('?', shape)
+    shape = NUMBER.sub('?', shape)
+    shape = IN_LIST.sub('IN (?)', shape)
+    shape = VALUES_LIST.sub('VALUES (?)', shape)
+    return SPACE.sub(' ', shape).strip()
+
+def caller(root, frame=None):
+    """
+    'file:line' of the innermost stack frame in code under root, skipping installed packages and this module.
+    The search starts at frame, or at the caller's frame.
+    """
+    for frame in reversed(traceback.extract_stack(frame or sys._getframe(1))):
+        filename = frame.filename
+        if filename.startswith(root) and 'site-packages' not in filename and filename != __file__:
+            return f'{os.path.relpath(filename, root)}:{frame.lineno}'
+    return 'unknown'
+
+def explain_rows(dbapi_connection, dialect, statement, parameters):
+    """
+    The plan of a statement as (column names, rows), run on a separate cursor of the same connection.
+    """
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(prefix + statement, parameters)
+        return [column[0] for column in cursor.description], cursor.fetchall()
+    finally:
+        cursor.close()
+
+def explain(dbapi_connection, dialect, statement, parameters):
+    """
+    The plan of a statement as text lines.
+    """
+    _, rows = explain_rows(dbapi_connection, dialect, statement, parameters)
+    return ['\t'.join(str(value) for value in row) for row in rows]
+
+def plan_problems(dialect, columns, rows):
+    """
+    The full table scans, filesorts and temporary tables in a plan from explain_rows, as text.
+    Scans in index order are not reported: with a LIMIT they stop early.
+    """
+    problems = []
+    for row in rows:
+        row = dict(zip(columns, row))
+        if dialect == 'sqlite':
+            detail = row['detail']
+            words = detail.split()
+            if words[0] == 'SCAN' and 'USING' not in words and words[1] != 'CONSTANT' and not words[1].startswith('('):
+                problems.append(f'full scan of {words[1]}')
+            elif detail.startswith('USE TEMP B-TREE FOR ORDER BY') or detail.startswith('USE TEMP B-TREE FOR RIGHT PART OF ORDER BY'):
+                problems.append('filesort')
+            elif detail.startswith('USE TEMP B-TREE'):
+                problems.append(f'temporary table for {detail[len("USE TEMP B-TREE FOR "):]}')
+            continue
+        # MySQL's tabular EXPLAIN
+        table, extra = row.get('table'), row.get('Extra') or ''
+        if row.get('type') == 'ALL':
+            problems.append(f'full scan of {table}')
+        if 'Using filesort' in extra:
+            problems.append(f'filesort on {table}')
+        if 'Using temporary' in extra:
+            problems.append(f'temporary table for {table}')
+    return problems
+
+class RequestProfile:
+    def __init__(self):
+        # shape -> [count, total seconds, first caller]
+        self.shapes = {}
+        self.statements = 0
+
+    def record(self, statement, elapsed, source):
+        self.statements += 1
+        shape = normalize(statement)
+        entry = self.shapes.get(shape)
+        if entry is None:
+            self.shapes[shape] = [1, elapsed, source]
+        else:
+            entry[0] += 1
+            entry[1] += elapsed
+
+    def repeated(self, max_repeats):
+        """
+        [(shape, count, total seconds, first caller)] for shapes run more than max_repeats times, most repeated first.
+        """
+        return sorted(
+            ((shape, count, elapsed, source) for shape, (count, elapsed, source) in self.shapes.items() if count > max_repeats),
+            key=lambda entry: -entry[1]
+        )
+
+    def problems(self, max_repeats, max_statements=None):
+        problems = [
+            f'{count} x {shape} ({elapsed * 1000:.1f} ms in total, first from {source})'
+            for shape, count, elapsed, source in self.repeated(max_repeats)
+        ]
+        if max_statements and self.statements > max_statements:
+            problems.append(f'{self.statements} statements, over the limit of {max_statements}')
+        return problems
+
+def is_explainable(statement):
+    words = statement.split(None, 1)
+    return bool(words) and words[0].upper() in ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+
+def report(log, endpoint, problems, strict=False):
+    if not problems:
+        return
+    message = f'Query profile of {endpoint}:\n  ' + '\n  '.join(problems)
+    log(message)
+    if strict:
+        raise QueryLimitExceeded(message)
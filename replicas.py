@@ -0,0 +1,92 @@
+"""
+Read replica selection for read-only routes, and the per-user window after a write during which that
+user's reads stay on the primary so they see their own changes despite replication lag.
+"""
+import hashlib
+import itertools
+import struct
+import threading
+import time
+
+from shared_memory import map_file
+
+STRATEGIES = ('round_robin', 'least_connections')
+UNTIL = struct.Struct('d')
+
+def checked_out(engine):
+    checkedout = getattr(engine.pool, 'checkedout', None)
+    return checkedout() if checkedout is not None else 0
+
+class ReplicaSet:
+    def __init__(self, engines, ping, strategy='round_robin', retry_interval=5):
+        """
+        ping(engine) returns whether the engine answers; replicas marked down are pinged again every retry_interval seconds.
+        """
+        if strategy not in STRATEGIES:
+            raise ValueError(f'Unknown replica strategy {strategy!r}; expected one of {", ".join(STRATEGIES)}')
+        self.engines = list(engines)
+        self.ping = ping
+        self.strategy = strategy
+        self.retry_interval = retry_interval
+        self.lock = threading.Lock()
+        # engine -> monotonic time of the next health check
+        self.down = {}
+        self.turns = itertools.count()
+
+    def choose(self):
+        """
+        A healthy replica engine, or None when all of them are down and reads should go to the primary.
+        """
+        now = time.monotonic()
+        with self.lock:
+            due = [engine for engine, check_at in self.down.items() if check_at <= now]
+            # Only one request re-checks a replica; the others keep avoiding it meanwhile.
+            for engine in due:
+                self.down[engine] = now + self.retry_interval
+        for engine in due:
+            if self.ping(engine):
+                with self.lock:
+                    self.down.pop(engine, None)
+        with self.lock:
+            healthy = [engine for engine in self.engines if engine not in self.down]
+        if not healthy:
+            return None
+        start = next(self.turns) % len(healthy)
+        healthy = healthy[start:] + healthy[:start]
+        if self.strategy == 'least_connections':
+            return min(healthy, key=checked_out)
+        return healthy[0]
+
+    def mark_down(self, engine):
+        with self.lock:
+            self.down[engine] = time.monotonic() + self.retry_interval
+
+    def dispose(self, close=True):
+        for engine in self.engines:
+            engine.dispose(close=close)
+
+class StickyWrites:
+    """
+    Remembers who wrote recently, in a memory-mapped file shared by the workers on the host, so a user's
+    next read stays on the primary whichever worker serves it. Each slot holds the monotonic time until
+    which the keys hashing to it are sticky; keys sharing a slot only keep each other on the primary.
+    """
+    def __init__(self, path, window=5, slots=65536):
+        self.window = window
+        self.slots = slots
+        self.until = map_file(path, slots * UNTIL.size)
+
+    def _slot(self, key):
+        index = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little') % self.slots
+        return index * UNTIL.size
+
+    def mark(self, key):
+        slot = self._slot(key)
+        until = time.monotonic() + self.window
+        if UNTIL.unpack_from(self.until, slot)[0] < until:
+            UNTIL.pack_into(self.until, slot, until)
+
+    def active(self, key):
+        if key is None:
+            return False
+        return UNTIL.unpack_from(self.until, self._slot(key))[0] > time.monotonic()
@@ -0,0 +1,55 @@
+"""
+Applies the SQL files in migrations/ in order, recording each one in the schema_migrations table.
+
+Files are named <version>_<description>.sql and hold statements separated by semicolons; comments are
+whole lines starting with --. MySQL commits DDL as it goes, so a migration that fails halfway has to be
+finished by hand and then recorded with `flask db stamp`.
+"""
+import os
+import re
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, func, inspect, insert, select
+
+FILENAME = re.compile(r'^(\d+)_[\w-]+\.sql$')
+
+metadata = MetaData()
+schema_migrations = Table(
+    'schema_migrations', metadata,
+    Column('version', String(32), primary_key=True),
+    Column('applied_at', DateTime, server_default=func.now())
+)
+
+def migration_files(directory):
+    """
+    [(version, path)] of the migrations in directory, in the order they apply.
+    """
+    migrations = []
+    for entry in os.listdir(directory):
+        match = FILENAME.match(entry)
+        if match:
+            migrations.append((match.group(1), os.path.join(directory, entry)))
+    return sorted(migrations, key=lambda migration: int(migration[0]))
+
+def statements(script):
+    lines = [line for line in script.splitlines() if not line.lstrip().startswith('--')]
+    return [statement.strip() for statement in '\n'.join(lines).split(';') if statement.strip()]
+
+def applied_versions(connection):
+    schema_migrations.create(connection, checkfirst=True)
+    return set(connection.scalars(select(schema_migrations.c.version)))
+
+def has_tables(engine, tables):
+    existing = set(inspect(engine).get_table_names())
+    return any(table in existing for table in tables)
+
+def record(connection, versions):
+    if versions:
+        connection.execute(insert(schema_migrations), [{'version': version} for version in versions])
+
+def apply(engine, version, path):
+    with open(path) as file:
+        script = file.read()
+    with engine.begin() as connection:
+        for statement in statements(script):
+            connection.exec_driver_sql(statement)
+        record(connection, [version])
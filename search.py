@@ -0,0 +1,103 @@
+"""
+In-process full-text search over posts, used when the database has no FULLTEXT support (SQLite, tests).
+MySQL deployments search with MATCH ... AGAINST instead; see search_post_ids in app.py.
+
+Each process holds its own index. Its own writes are applied to it as they commit, and post_search_index
+in app.py reads the posts and users other processes created every SEARCH_INDEX_REFRESH seconds. Posts
+deleted and names changed by other processes are only seen after a restart; deleted posts still drop out
+of the results, which the feed query loads from the database.
+"""
+from collections import Counter, defaultdict
+import math
+import re
+import threading
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return [token.lower() for token in TOKEN.findall(text or '')]
+
+class InvertedIndex:
+    """
+    Token -> {document id: term frequency}, scored with BM25.
+    """
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.terms = {}
+        self.lengths = {}
+        self.total_length = 0
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        terms = Counter(tokenize(text))
+        for term, frequency in terms.items():
+            self.postings[term][doc_id] = frequency
+        self.terms[doc_id] = list(terms)
+        self.lengths[doc_id] = sum(terms.values())
+        self.total_length += self.lengths[doc_id]
+
+    def remove(self, doc_id):
+        length = self.lengths.pop(doc_id, None)
+        if length is None:
+            return
+        self.total_length -= length
+        for term in self.terms.pop(doc_id):
+            del self.postings[term][doc_id]
+            if not self.postings[term]:
+                del self.postings[term]
+
+    def scores(self, query):
+        scores = defaultdict(float)
+        if not self.lengths:
+            return scores
+        average_length = self.total_length / len(self.lengths) or 1
+        for term in set(tokenize(query)):
+            docs = self.postings.get(term)
+            if not docs:
+                continue
+            idf = math.log(1 + (len(self.lengths) - len(docs) + 0.5) / (len(docs) + 0.5))
+            for doc_id, frequency in docs.items():
+                norm = 1 - self.b + self.b * self.lengths[doc_id] / average_length
+                scores[doc_id] += idf * frequency * (self.k1 + 1) / (frequency + self.k1 * norm)
+        return scores
+
+class PostSearchIndex:
+    """
+    Ranks posts by their content and by their author's username and names, like the MySQL FULLTEXT indexes do.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.contents = InvertedIndex()
+        self.authors = InvertedIndex()
+        self.post_authors = {}
+        self.author_posts = defaultdict(set)
+
+    def add_post(self, post_id, author_id, content):
+        with self.lock:
+            self.contents.add(post_id, content)
+            self.post_authors[post_id] = author_id
+            self.author_posts[author_id].add(post_id)
+
+    def remove_post(self, post_id):
+        with self.lock:
+            self.contents.remove(post_id)
+            author_id = self.post_authors.pop(post_id, None)
+            self.author_posts[author_id].discard(post_id)
+
+    def set_author(self, author_id, *names):
+        with self.lock:
+            self.authors.add(author_id, ' '.join(name for name in names if name))
+
+    def search(self, query, limit):
+        """
+        Returns up to limit post ids, best match first and newest first among equal scores.
+        """
+        with self.lock:
+            scores = self.contents.scores(query)
+            for author_id, score in self.authors.scores(query).items():
+                for post_id in self.author_posts.get(author_id, ()):
+                    scores[post_id] += score
+            return sorted(scores, key=lambda post_id: (-scores[post_id], -post_id))[:limit]
@@ -0,0 +1,46 @@
+"""
+Memory-mapped files shared by the workers on a host, for state that per-process caches must agree on.
+"""
+import hashlib
+import mmap
+import os
+import tempfile
+
+def default_path(name):
+    return os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), name)
+
+def map_file(path, size):
+    """
+    Maps the first size bytes of path, creating the file, or growing it, with zeros as needed.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if os.fstat(fd).st_size < size:
+            os.ftruncate(fd, size)
+        return mmap.mmap(fd, size)
+    finally:
+        os.close(fd)
+
+class Generations:
+    """
+    A random 8-byte generation per key, in slots of a shared file. Caches remember the generation they loaded
+    under and drop the entry once it changes; bump() changes it for every process. Keys sharing a slot just
+    invalidate each other.
+    """
+    SIZE = 8
+
+    def __init__(self, path, slots=65536):
+        self.slots = slots
+        self.map = map_file(path, slots * self.SIZE)
+
+    def _offset(self, key):
+        index = int.from_bytes(hashlib.blake2b(str(key).encode(), digest_size=8).digest(), 'little') % self.slots
+        return index * self.SIZE
+
+    def get(self, key):
+        offset = self._offset(key)
+        return self.map[offset:offset + self.SIZE]
+
+    def bump(self, key):
+        offset = self._offset(key)
+        self.map[offset:offset + self.SIZE] = os.urandom(self.SIZE)
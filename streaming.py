@@ -0,0 +1,35 @@
+"""
+Streaming JSON responses, so large listings go out while they are read instead of being built in memory first.
+"""
+from flask import Response, stream_with_context
+
+CHUNK_SIZE = 64 * 1024
+
+def json_array_chunks(items, dumps, chunk_size=CHUNK_SIZE):
+    """
+    Encodes items as one JSON array, yielding it in chunks of roughly chunk_size characters.
+    """
+    buffer, size, separator = ['['], 1, ''
+    for item in items:
+        encoded = dumps(item)
+        buffer.append(separator)
+        buffer.append(encoded)
+        separator = ','
+        size += len(encoded) + 1
+        if size >= chunk_size:
+            yield ''.join(buffer)
+            buffer, size = [], 0
+    buffer.append(']')
+    yield ''.join(buffer)
+
+def streamed_json_array(items, dumps, status=200, headers=None):
+    """
+    A chunked response streaming items as a JSON array. The request context stays available to the
+    items generator, and app-context teardown waits until the stream has been sent.
+    """
+    return Response(
+        stream_with_context(json_array_chunks(items, dumps)),
+        status=status,
+        headers=headers,
+        mimetype='application/json'
+    )
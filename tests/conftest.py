@@ -0,0 +1,39 @@
+"""
+app is configured from the environment when it is imported, so tests get it from the y fixture, which first
+points it at this session's temporary directory.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture(scope='session')
+def y(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('y')
+    os.environ.update({
+        'DB_URL': f'sqlite:///{directory / "y.db"}',
+        # Shared-memory files of their own, rather than the host's /dev/shm ones that a running app uses.
+        'AUTH_CACHE_SHM_PATH': str(directory / 'auth-cache'),
+        'DOWNVOTE_INDEX_SHM_PATH': str(directory / 'downvote-index'),
+        'DB_STICKY_SHM_PATH': str(directory / 'sticky-writes'),
+        'ADMISSION_SHM_PATH': str(directory / 'admission'),
+        # Authenticate against the database on every request, so each one issues the same statements.
+        'AUTH_CACHE_TTL': '0',
+        # A request that repeats a statement per row raises QueryLimitExceeded, failing its test.
+        'QUERY_PROFILER': '1',
+        'QUERY_PROFILER_STRICT': '1'
+    })
+    import app
+    return app
+
+@pytest.fixture(scope='module', autouse=True)
+def tables(y):
+    """
+    Each test module starts from empty tables.
+    """
+    y.Base.metadata.create_all(y.sql)
+    with y.sql.begin() as connection:
+        for table in y.Base.metadata.tables.values():
+            connection.execute(table.delete())
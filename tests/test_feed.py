@@ -0,0 +1,46 @@
+"""
+The feed is built in a fixed number of statements, whatever the page size.
+"""
+import pytest
+from sqlalchemy import event, insert
+
+POSTS = 30
+
+@pytest.fixture(scope='module')
+def client(y):
+    with y.sql.begin() as connection:
+        connection.execute(insert(y.Media.__table__), [{'id': media_id, 'base64': 'aGVsbG8='} for media_id in (1, 2)])
+        connection.execute(insert(y.User.__table__), [
+            {'id': user_id, 'username': f'user{user_id}', 'email': f'user{user_id}@example.com', 'password': 'password', 'media_id': 1}
+            for user_id in (1, 2)
+        ])
+        connection.execute(insert(y.Post.__table__), [
+            {'id': post_id, 'content': f'post {post_id}', 'author_id': 1 + post_id % 2, 'Media_id': 2}
+            for post_id in range(1, POSTS + 1)
+        ])
+    client = y.app.test_client()
+    api_key = client.post('/api/login', json={'username': 'user1', 'password': 'password'}).get_json()['api_key']
+    for post_id in range(1, POSTS + 1, 3):
+        client.put(f'/api/post/downvote/{post_id}', json={'username': 'user1', 'api_key': api_key})
+    client.api_key = api_key
+    return client
+
+def count_statements(y, client, **parameters):
+    statements = []
+    def record(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(y.sql, 'before_cursor_execute', record)
+    try:
+        response = client.get('/api/post', query_string={'username': 'user1', 'api_key': client.api_key, **parameters})
+    finally:
+        event.remove(y.sql, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements), response.get_json()
+
+@pytest.mark.parametrize('parameters', [{}, {'dislikes_only': '1'}, {'media': 'url'}])
+def test_statement_count_does_not_grow_with_page_size(y, client, parameters):
+    one, first_page = count_statements(y, client, limit=1, **parameters)
+    twenty, full_page = count_statements(y, client, limit=20, **parameters)
+    assert len(first_page) == 1
+    assert len(full_page) > 1
+    assert one == twenty
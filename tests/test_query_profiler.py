@@ -0,0 +1,14 @@
+"""
+Under the strict query profiler, a request over its statement budget raises, failing the test that made it.
+"""
+import pytest
+
+from query_profiler import QueryLimitExceeded
+
+def test_request_over_the_statement_budget_raises(y, monkeypatch):
+    client = y.app.test_client()
+    user = {'first_name': 'Budget', 'last_name': 'Test', 'username': 'budget', 'email': 'budget@example.com', 'password': 'password'}
+    assert client.put('/api/user', json=user).status_code == 201
+    monkeypatch.setattr(y, 'QUERY_PROFILER_MAX_STATEMENTS', 1)
+    with pytest.raises(QueryLimitExceeded):
+        client.post('/api/login', json={'username': 'budget', 'password': 'password'})